@@ -0,0 +1,94 @@
+"""
+Measures the latency of requests co-scheduled with a large find, with the documents hydrated on the event loop
+and offloaded to a thread or process pool. Requires a mongod listening on MONGO_URI:
+
+    MONGO_URI=mongodb://localhost:27017 python -m benchmarks.bench_offload
+"""
+import asyncio
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+from bson import ObjectId
+
+from mlight.attributes import FieldProperty
+from mlight.meta_model import MetaModel
+from mlight.session import DBSession
+
+DOCUMENTS = 200000
+BATCH_SIZE = 1000
+# interval of the co-scheduled requests, in seconds
+TICK = 0.001
+
+session = DBSession(os.environ.get('MONGO_URI', 'mongodb://localhost:27017'), 'mlight_bench_offload')
+
+
+class BenchDocument(MetaModel):
+    session = session
+    __model__ = 'bench_document'
+
+    _id = FieldProperty(ObjectId, if_missing=ObjectId)
+    name = FieldProperty(str, if_missing='')
+    age = FieldProperty(int, if_missing=0)
+    height = FieldProperty(float, if_missing=0.)
+    tags = FieldProperty(list, if_missing=list)
+    attributes = FieldProperty(dict, if_missing=dict)
+
+
+def records():
+    for index in range(DOCUMENTS):
+        yield dict(name='name %d' % index, age=index % 100, height=index / 3., tags=['a', 'b', 'c'],
+                   attributes={'index': index, 'even': index % 2 == 0})
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+async def measure(**kwargs):
+    """ :return: (seconds spent loading, lateness of each co-scheduled request in seconds) """
+    lateness = []
+    done = asyncio.Event()
+
+    async def requests():
+        while not done.is_set():
+            expected = time.perf_counter() + TICK
+            await asyncio.sleep(TICK)
+            lateness.append(time.perf_counter() - expected)
+
+    ticker = asyncio.ensure_future(requests())
+    start = time.perf_counter()
+    count = 0
+    async for _ in BenchDocument.iter(batch_size=BATCH_SIZE, **kwargs):
+        count += 1
+    elapsed = time.perf_counter() - start
+    done.set()
+    await ticker
+    assert count == DOCUMENTS
+    return elapsed, lateness
+
+
+async def main():
+    await BenchDocument.collection.drop()
+    await BenchDocument.insert_many(records())
+
+    print("%-22s %10s %12s %12s %12s" % ('mode', 'load', 'p50', 'p99', 'max'))
+    with ThreadPoolExecutor(2) as threads, ProcessPoolExecutor(2) as processes:
+        modes = [
+            ('event loop', dict()),
+            ('thread pool', dict(offload=True, executor=threads)),
+            ('process pool', dict(offload=True, executor=processes)),
+            ('process pool, 4 batches', dict(offload=True, executor=processes, max_in_flight=4)),
+        ]
+        for name, kwargs in modes:
+            elapsed, lateness = await measure(**kwargs)
+            print("%-22s %9.2fs %10.2fms %10.2fms %10.2fms" % (
+                name, elapsed, percentile(lateness, .5) * 1e3, percentile(lateness, .99) * 1e3,
+                max(lateness) * 1e3))
+
+    await session.client.drop_database(session.database_name)
+
+
+if __name__ == '__main__':
+    asyncio.get_event_loop().run_until_complete(main())
@@ -0,0 +1,50 @@
+""" Compares the generic schema construction and validation with the generated functions. """
+import timeit
+
+from bson import ObjectId
+
+from mlight.attributes import FieldProperty, ModelSchema
+from mlight.meta_model import MetaModel
+
+MESSAGES = MetaModel.__messages__
+FIELD_TYPES = [(int, 1), (str, 'value'), (float, 1.5), (bool, True)]
+REPEAT = 5
+
+
+def make_schema(field_count):
+    fields = dict(_id=FieldProperty(ObjectId, if_missing=ObjectId))
+    values = dict()
+    for index in range(field_count - 1):
+        data_type, value = FIELD_TYPES[index % len(FIELD_TYPES)]
+        name = 'field_%d' % index
+        # a third of the fields are required, a third have defaults
+        fields[name] = FieldProperty(data_type, required=index % 3 == 0, if_missing=value if index % 3 == 1 else None)
+        values[name] = value
+    return ModelSchema(fields), values
+
+
+def best_of(statement, number):
+    return min(timeit.repeat(statement, number=number, repeat=REPEAT)) / number * 1e6
+
+
+def main():
+    print("%8s %12s %14s %10s %12s %14s %10s" % (
+        'fields', 'construct', 'construct gen', 'speedup', 'validate', 'validate gen', 'speedup'))
+    for field_count in (10, 50, 200):
+        schema, values = make_schema(field_count)
+        construct, validate = schema.compile(MESSAGES)
+        document = construct(values)
+        number = max(100000 // field_count, 100)
+
+        generic_construct = best_of(lambda: schema.construct(values, MESSAGES), number)
+        generated_construct = best_of(lambda: construct(values), number)
+        generic_validate = best_of(lambda: schema.validate(document, MESSAGES), number)
+        generated_validate = best_of(lambda: validate(document), number)
+
+        print("%8d %10.2fus %12.2fus %9.2fx %10.2fus %12.2fus %9.2fx" % (
+            field_count, generic_construct, generated_construct, generic_construct / generated_construct,
+            generic_validate, generated_validate, generic_validate / generated_validate))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,11 +1,220 @@
+from collections import OrderedDict
+from types import MappingProxyType
+
+from mlight.tracking import TRACKED_TYPES
+
+
 class FieldProperty:
-    def __init__(self, data_type, required=False, if_missing=None):
+    def __init__(self, data_type, required=False, if_missing=None, tracked=False):
         """
 
         :param data_type:
         :param required:
         :param if_missing: callable or default value
+        :param tracked: for list and dict fields, when True in place changes are flushed with atomic
+        operators ($push, $addToSet, $pullAll, $set and $unset of keys)
         """
+        if tracked and data_type not in TRACKED_TYPES:
+            raise ValueError("Only %s fields can be tracked, got %s" % (list(TRACKED_TYPES.keys()), data_type))
         self.data_type = data_type
         self.required = required
         self.if_missing = if_missing
+        self.tracked = tracked
+        self.name = None
+
+    def __set_name__(self, owner, name):
+        self.name = name
+
+    def __get__(self, instance, owner):
+        # only reached when the field is not set on the instance
+        if instance is not None:
+            data = instance.__dict__
+            lazy = getattr(data, 'lazy', None)
+            if lazy is not None and self.name in lazy:
+                # decoded values are cached on the instance, they are not changes
+                value = lazy.decode(self.name)
+                if self.tracked:
+                    value = instance.track(self.name, value)
+                dict.__setitem__(data, self.name, value)
+                return value
+
+            loaded = getattr(data, 'loaded', None)
+            if loaded is not None and self.name not in loaded:
+                raise AttributeError(owner.__messages__['field_not_loaded'] % self.name)
+        return self
+
+
+class ModelSchema:
+    """
+    Frozen description of the FieldProperty definitions of a model class.
+    Built once when the class is created, fields declared on base models are included.
+    """
+    __slots__ = ["fields", "types", "required", "defaults", "tracked"]
+
+    def __init__(self, fields):
+        """
+        :param fields: mapping of field name -> FieldProperty, in declaration order
+        """
+        self.fields = MappingProxyType(OrderedDict(fields))
+        self.types = MappingProxyType({name: field.data_type for name, field in self.fields.items()})
+        self.required = tuple(name for name, field in self.fields.items() if field.required)
+        # (name, default value or factory, True if the default is a factory)
+        self.defaults = tuple((name, field.if_missing, callable(field.if_missing))
+                              for name, field in self.fields.items() if field.if_missing is not None)
+        # field name -> tracked container type, values of these fields may be of either type
+        self.tracked = MappingProxyType({name: TRACKED_TYPES[field.data_type]
+                                         for name, field in self.fields.items() if field.tracked})
+
+    @classmethod
+    def from_class(cls, model):
+        """ Collects the FieldProperty attributes of the model and of its bases, subclasses override bases. """
+        fields = OrderedDict()
+        for klass in reversed(model.__mro__):
+            for name, value in klass.__dict__.items():
+                if type(value) is FieldProperty:
+                    fields[name] = value
+        return cls(fields)
+
+    def construct(self, kwargs, messages):
+        """
+        Generic construction: fills defaults, checks required fields and data types.
+
+        :param kwargs: values provided by the user, extra keys are ignored
+        :param messages: error messages of the model
+        :return: dict with the values of the mapped fields
+        """
+        values = dict(kwargs)
+
+        # if some values are missing set them to their defaults
+        for name, if_missing, is_factory in self.defaults:
+            if name not in values:
+                values[name] = if_missing() if is_factory else if_missing
+
+        # check if attributes are missing
+        for name in self.required:
+            if name not in values:
+                raise AttributeError(messages['missing_attribute'] % name)
+
+        final_values = dict()
+        types = self.types
+        for key, value in values.items():
+            if key in types:
+                # validate the data type of each field
+                value_type = type(value)
+                if types[key] is not value_type and self.tracked.get(key) is not value_type:
+                    raise TypeError(messages['types_do_not_match'] % (key, value_type, types[key]))
+                final_values[key] = value
+        return final_values
+
+    def validate(self, values, messages):
+        """
+        Generic validation: every value must be mapped by a field with a matching data type.
+
+        :param values: the values of an instance
+        :param messages: error messages of the model
+        """
+        types = self.types
+        for key, value in values.items():
+            if key not in types:
+                raise AttributeError(messages['err_missing_attribute'] % key)
+
+            value_type = type(value)
+            if value_type is not types[key] and self.tracked.get(key) is not value_type:
+                raise TypeError(messages['err_unexpected_attribute'] % (key, value_type, types[key]))
+
+    def compile(self, messages):
+        """
+        Generates construct and validate functions specialized for this schema, with the same
+        behaviour as the generic methods but without per field lookups and loops.
+
+        :param messages: error messages of the model
+        :return: tuple (construct(kwargs), validate(values))
+        """
+        # tracked fields usually hold their tracked container on instances
+        type_tuple = tuple(self.tracked.get(name, data_type) for name, data_type in self.types.items())
+        namespace = dict(_missing=_MISSING, _messages=messages, _types=self.types, _fields=frozenset(self.fields),
+                         _names=tuple(self.fields), _type_tuple=type_tuple, _tracked=self.tracked)
+        construct_lines = ["def construct(kwargs):", "    get = kwargs.get"]
+        check_lines = []
+        # the fast path covers instances with every field set, in declaration order, as produced by construct
+        validate_lines = [
+            "def validate(values):",
+            "    if tuple(values) == _names and tuple(map(type, values.values())) == _type_tuple:",
+            "        return",
+            "    if not _fields.issuperset(values):",
+            "        for key in values:",
+            "            if key not in _fields:",
+            "                raise AttributeError(_messages['err_missing_attribute'] % key)",
+            "    for key, value in values.items():",
+            "        if type(value) is not _types[key] and type(value) is not _tracked.get(key):",
+            "            raise TypeError(_messages['err_unexpected_attribute'] % (key, type(value), _types[key]))",
+        ]
+
+        defaults = {name: is_factory for name, _, is_factory in self.defaults}
+        for index, (name, field) in enumerate(self.fields.items()):
+            key = repr(name)
+            namespace['_type_%d' % index] = field.data_type
+
+            construct_lines.append("    value_%d = get(%s, _missing)" % (index, key))
+            if name in defaults:
+                namespace['_default_%d' % index] = field.if_missing
+                construct_lines.append("    if value_%d is _missing:" % index)
+                construct_lines.append("        value_%d = _default_%d%s" % (
+                    index, index, "()" if defaults[name] else ""))
+
+            condition = "type(value_%d) is not _type_%d" % (index, index)
+            if name in self.tracked:
+                namespace['_tracked_%d' % index] = self.tracked[name]
+                condition += " and type(value_%d) is not _tracked_%d" % (index, index)
+            type_check = [
+                "if %s:" % condition,
+                "    raise TypeError(_messages['types_do_not_match'] %% (%s, type(value_%d), _type_%d))" % (
+                    key, index, index),
+                "values[%s] = value_%d" % (key, index),
+            ]
+            if name in defaults:
+                check_lines.extend("    " + line for line in type_check)
+            else:
+                check_lines.append("    if value_%d is not _missing:" % index)
+                check_lines.extend("        " + line for line in type_check)
+
+        # required fields are checked once every default is set, like the generic construction
+        for index, name in enumerate(self.fields):
+            if name in self.required and name not in defaults:
+                construct_lines.append("    if value_%d is _missing:" % index)
+                construct_lines.append("        raise AttributeError(_messages['missing_attribute'] %% %r)" % name)
+
+        construct_lines.append("    values = dict()")
+        construct_lines.extend(check_lines)
+        construct_lines.append("    return values")
+
+        exec("\n".join(construct_lines) + "\n\n" + "\n".join(validate_lines), namespace)
+        return namespace['construct'], namespace['validate']
+
+    def compile_loader(self):
+        """
+        Generates a load(document) function for documents trusted to come from the database:
+        it picks the mapped fields and fills defaults, without required or data type checks.
+
+        :return: load(document)
+        """
+        namespace = dict(_missing=_MISSING)
+        lines = ["def load(document):", "    get = document.get", "    values = dict()"]
+        for index, (name, field) in enumerate(self.fields.items()):
+            key = repr(name)
+            lines.append("    value = get(%s, _missing)" % key)
+            lines.append("    if value is not _missing:")
+            lines.append("        values[%s] = value" % key)
+            if field.if_missing is not None:
+                namespace['_default_%d' % index] = field.if_missing
+                lines.append("    else:")
+                lines.append("        values[%s] = _default_%d%s" % (
+                    key, index, "()" if callable(field.if_missing) else ""))
+        lines.append("    return values")
+
+        exec("\n".join(lines), namespace)
+        return namespace['load']
+
+
+# marks values which were not provided in generated code
+_MISSING = object()
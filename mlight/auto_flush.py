@@ -0,0 +1,101 @@
+import asyncio
+
+from mlight.unit_of_work import _current, current_unit_of_work
+
+
+class AutoFlusher:
+    """
+    Background task of a DBSession flushing the dirty objects of its models once max_dirty objects are waiting
+    or every interval seconds, whichever comes first.
+    Objects changed within units of work are left to their unit.
+    """
+
+    def __init__(self, session, max_dirty=1000, interval=1.0, on_error=None, **flush_kwargs):
+        """
+        :param session: the DBSession whose registered models are flushed.
+        :param max_dirty: number of objects waiting to be flushed which triggers a flush.
+        :param interval: maximum seconds between two flushes.
+        :param on_error: called with the exception of a failed flush, the objects stay dirty and are retried
+        after interval seconds. When None the last error is raised by stop().
+        :param flush_kwargs: passed to DBSession.flush_all.
+        """
+        if max_dirty < 1:
+            raise ValueError("max_dirty must be a positive integer, got %s" % max_dirty)
+        if interval <= 0:
+            raise ValueError("interval must be positive, got %s" % interval)
+        self.session = session
+        self.max_dirty = max_dirty
+        self.interval = interval
+        self.on_error = on_error
+        self.flush_kwargs = flush_kwargs
+        self.flushes = 0
+        self.errors = 0
+        self._wake = asyncio.Event()
+        self._stopping = False
+        self._error = None
+        self._task = None
+
+    @property
+    def running(self):
+        return self._task is not None and not self._task.done()
+
+    def start(self):
+        """ Schedules the background task on the event loop. """
+        if not self.running:
+            self._stopping = False
+            self._task = asyncio.ensure_future(self._run())
+
+    def notify(self, model):
+        """
+        Called when an object of the model is attached, wakes the task once max_dirty objects wait.
+        Objects of units of work are flushed by their unit.
+        """
+        if current_unit_of_work() is None and len(model.to_flush) >= self.max_dirty:
+            self._wake.set()
+
+    async def stop(self):
+        """ Flushes the objects still waiting and waits for the task to end. """
+        if self._task is not None:
+            self._stopping = True
+            self._wake.set()
+            await self._task
+            self._task = None
+        error, self._error = self._error, None
+        if error is not None:
+            raise error
+
+    async def _run(self):
+        # the task copied the context it was started from, it flushes the session objects outside of any unit
+        _current.set(None)
+        while True:
+            try:
+                await asyncio.wait_for(self._wake.wait(), self.interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wake.clear()
+            failed = not await self.flush()
+            if self._stopping:
+                return
+            if failed:
+                # do not retry right away objects which keep failing
+                await asyncio.sleep(self.interval)
+
+    async def flush(self):
+        """
+        Flushes the dirty objects of the session, failures are reported and do not stop the task.
+
+        :return: False if the flush failed.
+        """
+        if len(self.session.dirty_objects()) == 0:
+            return True
+        try:
+            await self.session.flush_all(**self.flush_kwargs)
+        except Exception as e:
+            self.errors += 1
+            if self.on_error is not None:
+                self.on_error(e)
+            else:
+                self._error = e
+            return False
+        self.flushes += 1
+        return True
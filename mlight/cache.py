@@ -0,0 +1,86 @@
+import time
+from collections import OrderedDict
+
+
+class CacheBackend:
+    """
+    Interface of the second level caches used by MetaModel.get, documents are stored by _id.
+    Backends keep the hits, misses and evictions counters up to date.
+    """
+
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        """ :return: the cached document, None if missing. """
+        raise NotImplementedError()
+
+    def set(self, key, document):
+        """ Stores the document. """
+        raise NotImplementedError()
+
+    def delete(self, key):
+        """ Removes the document if present. """
+        raise NotImplementedError()
+
+    def clear(self):
+        """ Removes all documents. """
+        raise NotImplementedError()
+
+
+class LRUCache(CacheBackend):
+    """
+    In process cache which keeps at most max_size documents, evicting the least recently used,
+    each document expires ttl seconds after being stored.
+    """
+
+    def __init__(self, max_size=1024, ttl=None, timer=time.monotonic):
+        """
+        :param max_size: maximum number of documents held.
+        :param ttl: seconds after which a document expires, None to never expire.
+        :param timer: returns the current time in seconds.
+        """
+        super(LRUCache, self).__init__()
+        if max_size < 1:
+            raise ValueError("max_size must be a positive integer, got %s" % max_size)
+        self.max_size = max_size
+        self.ttl = ttl
+        self.timer = timer
+        # key -> (expiration time, document)
+        self._entries = OrderedDict()
+
+    def get(self, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+
+        expires_at, document = entry
+        if expires_at is not None and expires_at <= self.timer():
+            del self._entries[key]
+            self.evictions += 1
+            self.misses += 1
+            return None
+
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return document
+
+    def set(self, key, document):
+        expires_at = None if self.ttl is None else self.timer() + self.ttl
+        self._entries[key] = (expires_at, document)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def delete(self, key):
+        self._entries.pop(key, None)
+
+    def clear(self):
+        self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
@@ -0,0 +1,135 @@
+"""
+Columnar query results, numpy is required and pyarrow is needed for Arrow tables:
+
+    pip install mlight[columns]
+"""
+import datetime
+from collections import OrderedDict
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+try:
+    import pyarrow
+except ImportError:
+    pyarrow = None
+
+# numpy dtype used for each FieldProperty data type, other types are stored as objects
+NUMPY_TYPES = {
+    int: 'int64',
+    float: 'float64',
+    bool: 'bool',
+    datetime.datetime: 'datetime64[ms]',
+}
+
+# value stored in place of missing values, hidden by the mask
+_FILL_VALUES = {
+    'int64': 0,
+    'float64': 0.,
+    'bool': False,
+    'datetime64[ms]': numpy.datetime64(0, 'ms') if numpy is not None else None,
+}
+
+
+def require_numpy():
+    if numpy is None:
+        raise ImportError("numpy is required for columnar results: pip install numpy")
+
+
+class ColumnBuilder:
+    """
+    Accumulates the values of a field and converts them to masked numpy arrays, one chunk at a time,
+    so at most a chunk of python values is held in memory.
+    """
+
+    def __init__(self, name, data_type):
+        require_numpy()
+        self.name = name
+        self.dtype = NUMPY_TYPES.get(data_type, 'object')
+        self.values = []
+        self.chunks = []
+
+    def append(self, value):
+        self.values.append(value)
+
+    def flush(self):
+        """ Converts the pending values to a masked array chunk. """
+        if len(self.values) == 0:
+            return
+        mask = numpy.fromiter((value is None for value in self.values), dtype='bool', count=len(self.values))
+        if self.dtype == 'object':
+            data = numpy.empty(len(self.values), dtype='object')
+            data[:] = self.values
+        else:
+            fill = _FILL_VALUES[self.dtype]
+            data = numpy.array([fill if value is None else value for value in self.values], dtype=self.dtype)
+        self.chunks.append(numpy.ma.MaskedArray(data, mask=mask))
+        self.values = []
+
+    def build(self):
+        """ :return: the masked array holding every value, missing values are masked. """
+        self.flush()
+        if len(self.chunks) == 0:
+            return numpy.ma.MaskedArray(numpy.empty(0, dtype=self.dtype), mask=numpy.empty(0, dtype='bool'))
+        return numpy.ma.concatenate(self.chunks) if len(self.chunks) > 1 else self.chunks[0]
+
+
+def to_arrow(columns):
+    """
+    :param columns: dict of name -> masked array
+    :return: pyarrow.Table with a column for each masked array, masked values are nulls
+    """
+    if pyarrow is None:
+        raise ImportError("pyarrow is required for Arrow results: pip install pyarrow")
+    arrays = OrderedDict()
+    for name, column in columns.items():
+        mask = numpy.ma.getmaskarray(column)
+        data = column.data
+        if data.dtype == object:
+            arrays[name] = pyarrow.array([None if masked else value for value, masked in zip(data, mask)])
+        else:
+            arrays[name] = pyarrow.array(data, mask=mask)
+    return pyarrow.table(arrays)
+
+
+async def find_columns(model, filter=None, fields=None, batch_size=None, as_arrow=False):
+    """
+    Executes a find on the model collection and returns the values of the requested fields as columns,
+    without creating mapped instances.
+
+    :param model: MetaModel subclass.
+    :param filter: query filter, None to match every document.
+    :param fields: names of the fields to return, defaults to every field of the model.
+    :param batch_size: number of documents fetched with each round trip and converted at once.
+    :param as_arrow: when True returns a pyarrow.Table instead of masked arrays.
+    :return: dict of field name -> numpy masked array, missing values are masked
+    """
+    require_numpy()
+    types = model.__schema__.types
+    fields = list(types.keys() if fields is None else fields)
+    projection = model.projection(fields)
+    if '_id' not in fields:
+        projection['_id'] = False
+
+    builders = [ColumnBuilder(name, types[name]) for name in fields]
+    chunk_size = batch_size if batch_size is not None else 10000
+
+    cursor = model.collection.find(filter if filter is not None else dict(), projection)
+    if batch_size is not None:
+        cursor.batch_size(batch_size)
+
+    count = 0
+    while await cursor.fetch_next:
+        get = cursor.next_object().get
+        for builder in builders:
+            builder.append(get(builder.name))
+        count += 1
+        if count == chunk_size:
+            for builder in builders:
+                builder.flush()
+            count = 0
+
+    columns = OrderedDict((builder.name, builder.build()) for builder in builders)
+    return to_arrow(columns) if as_arrow else columns
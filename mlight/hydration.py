@@ -0,0 +1,79 @@
+"""
+Hydration of large result sets outside of the event loop: the cursor returns raw BSON batches which are decoded
+and loaded by an executor while the loop keeps fetching the next batches and serving other coroutines.
+Only the cheap creation of the objects and the identity map updates run on the loop.
+"""
+import asyncio
+from collections import deque
+
+from bson import decode_all
+
+# maximum number of batches decoded at the same time by default
+DEFAULT_MAX_IN_FLIGHT = 2
+
+
+def load_batch(model, raw_batch, loaded=None):
+    """
+    Decodes a raw BSON batch and builds the field values of its documents, runs in the executor.
+    With a process pool the model is pickled by reference, it must be importable by the workers.
+
+    :return: list of (values, changed) tuples, changed holds the fields filled in with their defaults.
+    """
+    results = []
+    for document in decode_all(raw_batch):
+        values = model.load_values(document, model.sample_validation(), loaded)
+        results.append((values, values.keys() - document.keys()))
+    return results
+
+
+def map_batch(model, batch, loaded=None, attached=False):
+    """ :return: the objects of a batch built by load_batch, created on the event loop. """
+    session = model.session
+    objects = []
+    for values, changed in batch:
+        obj = session.lookup(model, values.get('_id'))
+        if obj is None:
+            obj = model.from_values(values, changed, loaded, None, attached)
+        else:
+            obj.merge_document({key: value for key, value in values.items() if key not in changed}, loaded)
+            if attached:
+                obj.attach()
+        objects.append(obj)
+    return objects
+
+
+async def iter_offloaded(model, *args, batch_size=None, attached=False, fields=None, executor=None,
+                         max_in_flight=DEFAULT_MAX_IN_FLIGHT, **find_kwargs):
+    """
+    Executes a find on the model collection and yields mapped instances, the batches are decoded
+    by the executor. At most max_in_flight batches are fetched and waiting to be decoded, the cursor
+    is not read further until the oldest batch is mapped.
+
+    :param executor: concurrent.futures executor, None for the default thread pool of the loop.
+    A process pool decodes in parallel at the cost of pickling the values back.
+    :param max_in_flight: maximum number of batches decoded at the same time.
+    :param find_kwargs: options sent to the collection.find_raw_batches.
+    """
+    if max_in_flight < 1:
+        raise ValueError("max_in_flight must be a positive integer, got %s" % max_in_flight)
+
+    loaded = model.loaded_fields(fields)
+    loop = asyncio.get_event_loop()
+    cursor = model.collection.find_raw_batches(*args, **model.find_options(fields, **find_kwargs))
+    if batch_size is not None:
+        cursor.batch_size(batch_size)
+
+    pending = deque()
+    try:
+        while await cursor.fetch_next:
+            pending.append(loop.run_in_executor(executor, load_batch, model, cursor.next_object(), loaded))
+            if len(pending) >= max_in_flight:
+                for obj in map_batch(model, await pending.popleft(), loaded, attached):
+                    yield obj
+        while len(pending) > 0:
+            for obj in map_batch(model, await pending.popleft(), loaded, attached):
+                yield obj
+    finally:
+        for future in pending:
+            future.cancel()
+        await cursor.close()
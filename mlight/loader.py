@@ -0,0 +1,74 @@
+import asyncio
+from collections import OrderedDict
+from copy import deepcopy
+
+
+class BatchLoader:
+    """
+    Coalesces the documents requested by _id within a short window into a single
+    find({'_id': {'$in': [...]}}) query, and fans the results back out to each caller.
+    """
+
+    def __init__(self, model, window=0, max_batch_size=1000):
+        """
+        :param model: the MetaModel subclass whose collection is queried.
+        :param window: seconds to wait for more requests, 0 to wait only for the current loop iteration.
+        :param max_batch_size: maximum number of _id sent with a single query.
+        """
+        self.model = model
+        self.window = window
+        self.max_batch_size = max_batch_size
+        # _id -> futures of the callers waiting for it, one per caller so cancelling one does not affect the others
+        self._pending = OrderedDict()
+        self._handle = None
+
+    def load(self, _id):
+        """
+        Schedules the document to be loaded with the next batch.
+
+        :return: future resolved with the document, None if it does not exist.
+        """
+        loop = asyncio.get_event_loop()
+        future = loop.create_future()
+        self._pending.setdefault(_id, []).append(future)
+
+        if len(self._pending) >= self.max_batch_size:
+            self.dispatch()
+        elif self._handle is None:
+            if self.window > 0:
+                self._handle = loop.call_later(self.window, self.dispatch)
+            else:
+                self._handle = loop.call_soon(self.dispatch)
+        return future
+
+    def dispatch(self):
+        """ Sends the query for the documents requested so far. """
+        if self._handle is not None:
+            self._handle.cancel()
+            self._handle = None
+
+        pending, self._pending = self._pending, OrderedDict()
+        if len(pending) > 0:
+            asyncio.ensure_future(self._resolve(pending))
+
+    async def _resolve(self, pending):
+        documents = dict()
+        try:
+            cursor = self.model.read_collection.find({'_id': {'$in': list(pending.keys())}})
+            while await cursor.fetch_next:
+                document = cursor.next_object()
+                documents[document['_id']] = document
+        except Exception as e:
+            for futures in pending.values():
+                for future in futures:
+                    if not future.done():
+                        future.set_exception(e)
+            return
+
+        for _id, futures in pending.items():
+            document = documents.get(_id)
+            # callers may have been cancelled in the meantime
+            futures = [future for future in futures if not future.done()]
+            for index, future in enumerate(futures):
+                # each caller maps its own copy, instances must not share mutable values
+                future.set_result(document if index == 0 or document is None else deepcopy(document))
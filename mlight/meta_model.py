@@ -1,11 +1,37 @@
-from collections import deque
+import asyncio
+from collections import deque, OrderedDict
+from copy import deepcopy
+from itertools import islice
+from random import random
 
 from bson import ObjectId
-from weakreflist.weakreflist import WeakList
-
-from mlight.attributes import FieldProperty
+from bson.codec_options import CodecOptions
+from bson.raw_bson import RawBSONDocument
+from pymongo import InsertOne, UpdateOne
+from pymongo.errors import BulkWriteError
+
+from mlight.attributes import ModelSchema
+from mlight.columns import find_columns
+from mlight.hydration import DEFAULT_MAX_IN_FLIGHT, iter_offloaded
+from mlight.prefetch import PrefetchCursor
+from mlight.query import Query
 from mlight.session import DBSession
-from mlight.utils import classproperty, DataDict
+from mlight.tracking import TrackedValue
+from mlight.unit_of_work import current_unit_of_work
+from mlight.utils import classproperty, DataDict, FlushResult, InsertResult, WeakIdentitySet, LazyDocument
+
+# maximum number of operations sent to the database with a single bulk_write
+DEFAULT_BATCH_SIZE = 1000
+
+# object lifecycle states
+# created and not in the flushing list
+TRANSIENT = 'transient'
+# created and in the flushing list, it will be inserted
+PENDING = 'pending'
+# loaded from or written to the database and held by the session identity map
+PERSISTENT = 'persistent'
+# loaded from or written to the database but no longer held by the session identity map
+DETACHED = 'detached'
 
 
 class MetaModel:
@@ -23,7 +49,11 @@ class MetaModel:
         provide_valid_session="Must provide a valid session",
         missing_attribute="Missing attribute: '%s'",
         types_do_not_match="Types do not match for field '%s': provided %s, expected %s",
-        missing_id_field="Missing '_id' field of type %s"
+        missing_id_field="Missing '_id' field of type %s",
+        invalid_batch_size="Batch size must be a positive integer, got %s",
+        unknown_field="Unknown field '%s'",
+        field_not_loaded="Field '%s' was not loaded, use load() to fetch it",
+        flush_not_loaded="Cannot flush field '%s' which was never loaded"
     )
 
     # collection name to be mapped on the database
@@ -38,43 +68,394 @@ class MetaModel:
     # define unique keys with pymongo syntax
     unique_indexes = []
 
-    to_flush = WeakList()
+    # when True concurrent get() calls are coalesced into a single $in query by the session BatchLoader
+    batch_get = False
+
+    # seconds the BatchLoader waits for more get() calls, 0 to batch the calls of the same loop iteration
+    batch_get_window = 0
+
+    # when True queries return raw BSON documents and each field is decoded on first access
+    raw_documents = False
+
+    # optional mlight.cache.CacheBackend serving get() by _id, documents are invalidated when flushed
+    cache = None
+
+    # FieldProperty definitions of the model, collected when the class is created
+    __schema__ = ModelSchema(dict())
+
+    # construct(kwargs), validate(values) and load(document) functions generated from __schema__
+    __construct__ = None
+    __validate__ = None
+    __load__ = None
+
+    # fraction, between 0 and 1, of the documents loaded from the database which are fully validated
+    load_validation_rate = 0.0
+
+    # objects waiting to be flushed outside of units of work
+    _to_flush = WeakIdentitySet()
+
+    @classproperty
+    def to_flush(cls):
+        """ :return: the objects waiting to be flushed, those of the current unit of work if any. """
+        unit_of_work = current_unit_of_work()
+        return cls._to_flush if unit_of_work is None else unit_of_work.objects
+
+    def __init_subclass__(cls, **kwargs):
+        super(MetaModel, cls).__init_subclass__(**kwargs)
+        cls.__schema__ = ModelSchema.from_class(cls)
+        construct, validate = cls.__schema__.compile(cls.__messages__)
+        cls.__construct__ = staticmethod(construct)
+        cls.__validate__ = staticmethod(validate)
+        cls.__load__ = staticmethod(cls.__schema__.compile_loader())
 
     @classmethod
-    async def flush_all(cls, check_integrity=True):
-        """ Called by the ORM to sync the object to the database. """
+    async def flush_all(cls, check_integrity=True, batch_size=DEFAULT_BATCH_SIZE, ordered=True):
+        """
+        Called by the ORM to sync the object to the database.
+        Objects are grouped by collection and written with chunked bulk_write calls.
+
+        :param check_integrity: if False skips the mapping check on each document.
+        :param batch_size: maximum number of operations sent with a single bulk_write.
+        :param ordered: if False the server is allowed to apply the operations of a batch in any order.
+        :return: dict of collection name -> FlushResult
+        """
+        results = OrderedDict()
+        for collection_name, objects in cls.dirty_objects().items():
+            model = objects[0].__class__
+            results[collection_name] = await model.bulk_flush(objects, check_integrity=check_integrity,
+                                                              batch_size=batch_size, ordered=ordered)
+        return results
+
+    @classmethod
+    def dirty_objects(cls):
+        """
+        :return: dict of collection name -> list of the objects of this model waiting to be flushed
+        """
+        groups = OrderedDict()
         for obj in cls.to_flush:
-            await obj.flush(check_integrity)
-            cls.to_flush.remove(obj)
+            if isinstance(obj, cls):
+                groups.setdefault(obj.__class__.__model__, []).append(obj)
+        return groups
+
+    @classmethod
+    async def bulk_flush(cls, objects, check_integrity=True, batch_size=DEFAULT_BATCH_SIZE, ordered=True,
+                         client_session=None, taken=None):
+        """
+        Writes the objects to the model collection using bulk_write, batch_size operations at a time.
+        Objects are removed from the flushing list only after their batch is written, the changes made
+        while it is written are kept. The changes of the writes which failed are tracked again.
+        With a write-behind session the objects are buffered instead and the result is empty.
+
+        :param client_session: motor client session the writes belong to, e.g. to run them in a transaction.
+        :param taken: if given the objects are not marked as flushed: the (object, changes) pairs written are
+        appended to it, the caller marks them once the writes are committed, see DataDict.take_changes.
+        :return: FlushResult for the collection
+        """
+        if batch_size < 1:
+            raise ValueError(cls.__messages__['invalid_batch_size'] % batch_size)
+
+        result = FlushResult(cls.__model__)
+        write_buffer = cls.session.write_buffer
+        if write_buffer is not None:
+            for obj in objects:
+                if check_integrity:
+                    obj.check_integrity()
+                await write_buffer.add(obj)
+            return result
+
+        for start in range(0, len(objects), batch_size):
+            batch = objects[start:start + batch_size]
+            if check_integrity:
+                for obj in batch:
+                    obj.check_integrity()
+            operations = deque()
+            # (object, changes) of the batch, in the order of the objects
+            changes = deque()
+            # (object, changes) written by the operation at the same index
+            written = deque()
+            try:
+                for obj in batch:
+                    operation = obj.flush_operation()
+                    changes.append((obj, obj.__dict__.take_changes()))
+                    # unchanged objects do not need a round trip
+                    if operation is not None:
+                        operations.append(operation)
+                        written.append(changes[-1])
+
+                if len(operations) > 0:
+                    result.add(await cls.collection.bulk_write(list(operations), ordered=ordered,
+                                                               session=client_session))
+            except BulkWriteError as e:
+                # the writes which succeeded must not be sent again, e.g. $inc or inserts
+                failed = written if taken is not None else cls.flushed_before_error(written, e, ordered)
+                for obj, obj_changes in failed:
+                    obj.__dict__.restore_changes(obj_changes)
+                raise
+            except BaseException:
+                for obj, obj_changes in changes:
+                    obj.__dict__.restore_changes(obj_changes)
+                raise
+
+            if taken is not None:
+                taken.extend(changes)
+            else:
+                for obj, obj_changes in changes:
+                    obj.flushed(obj_changes)
+        return result
+
+    @staticmethod
+    def flushed_before_error(written, error, ordered):
+        """
+        Marks as flushed the objects whose operation succeeded in a failed bulk_write.
+
+        :param written: the (object, changes) pairs, in the order of their operations.
+        :param error: the BulkWriteError raised.
+        :param ordered: whether the bulk_write stopped at the first error.
+        :return: the (object, changes) pairs whose operation was not applied
+        """
+        failed = {write_error['index'] for write_error in error.details.get('writeErrors', [])}
+        first_failed = min(failed) if len(failed) > 0 else len(written)
+        not_written = []
+        for index, (obj, changes) in enumerate(written):
+            if index < first_failed if ordered else index not in failed:
+                obj.flushed(changes)
+            else:
+                not_written.append((obj, changes))
+        return not_written
+
+    @classmethod
+    async def insert_many(cls, records, batch_size=DEFAULT_BATCH_SIZE, ordered=False):
+        """
+        Validates and inserts records without creating mapped instances, batch_size records at a time,
+        so generators can be streamed with flat memory.
+        Invalid records are reported and skipped, they do not abort the load.
+
+        :param records: iterable of dicts, validated like the keyword arguments of __init__.
+        :param batch_size: number of records validated and sent with a single insert_many.
+        :param ordered: if True the server stops at the first write error and so does the load.
+        :return: InsertResult, errors hold the index of the failed records
+        """
+        if batch_size < 1:
+            raise ValueError(cls.__messages__['invalid_batch_size'] % batch_size)
+
+        result = InsertResult(cls.__model__)
+        records = iter(records)
+        index = 0
+        while True:
+            batch = list(islice(records, batch_size))
+            if len(batch) == 0:
+                break
+
+            documents = []
+            # index of the record each document comes from
+            indexes = []
+            for record in batch:
+                try:
+                    values = cls.__construct__(record)
+                    if '_id' not in values:
+                        raise AttributeError(cls.__messages__['missing_id_field'] % ObjectId)
+                except (AttributeError, TypeError) as e:
+                    result.errors.append((index, e))
+                else:
+                    documents.append(values)
+                    indexes.append(index)
+                index += 1
+
+            if len(documents) == 0:
+                continue
+
+            result.batches += 1
+            try:
+                write_result = await cls.collection.insert_many(documents, ordered=ordered)
+                result.inserted_count += len(write_result.inserted_ids)
+            except BulkWriteError as e:
+                result.inserted_count += e.details['nInserted']
+                for write_error in e.details['writeErrors']:
+                    result.errors.append((indexes[write_error['index']], write_error))
+                if ordered:
+                    break
+
+        result.errors.sort(key=lambda error: error[0])
+        return result
+
+    def check_integrity(self):
+        """ Checks that every attribute is mapped by a FieldProperty with a matching data type. """
+        self.__validate__(self.__dict__)
+
+    def flush_update(self):
+        """
+        Only the fields set or deleted since the object was loaded or last flushed are sent.
+
+        :return: the update document which syncs the database with the object, None if nothing changed.
+        """
+        data = self.__dict__
+        if data.loaded is not None:
+            for key in data.changed.union(data.deleted, data.operators):
+                if key not in data.loaded:
+                    raise AttributeError(self.__messages__['flush_not_loaded'] % key)
+
+        update = dict()
+        if len(data.changed) > 0:
+            update['$set'] = {key: data[key] for key in data.changed}
+        if len(data.deleted) > 0:
+            update['$unset'] = {key: '' for key in data.deleted}
+        for key, (operator, values) in data.operators.items():
+            if operator in ('$push', '$addToSet'):
+                update.setdefault(operator, dict())[key] = {'$each': values}
+            elif operator in ('$inc', '$pullAll'):
+                update.setdefault(operator, dict())[key] = values
+            else:
+                # $set and $unset of the keys of a tracked dict
+                target = update.setdefault(operator, dict())
+                for sub_key, value in values.items():
+                    target['%s.%s' % (key, sub_key)] = value
+        return update if len(update) > 0 else None
+
+    def track(self, name, value):
+        """
+        :return: the value of a tracked field wrapped in its tracked container bound to this object,
+        values of other fields are returned as they are.
+        """
+        schema = self.__class__.__schema__
+        tracked_type = schema.tracked.get(name)
+        if tracked_type is None:
+            return value
+        if type(value) is tracked_type:
+            if value.is_bound_to(self, name):
+                return value
+        elif type(value) is not schema.types[name]:
+            # wrong data types are reported by the integrity checks
+            return value
+        return tracked_type(value, self, name)
+
+    def record_operator(self, name, operator, values):
+        """
+        Records an in place change of a field, which is flushed with an atomic operator.
+        Different operators on the same field are not compatible: the whole field is set instead.
+
+        :param name: the field name.
+        :param operator: $inc, $push, $addToSet, $pullAll, $set or $unset, None to set the whole field.
+        :param values: the operator argument, merged with the one already recorded.
+        """
+        self.data_set_changed()
+        data = self.__dict__
+        # new objects are inserted and changed fields are sent as a whole anyway
+        if data.new or name in data.changed:
+            return
+        if operator is None:
+            data.mark_changed(name)
+            return
+
+        current = data.operators.get(name)
+        if current is None:
+            data.operators[name] = (operator, values)
+        elif current[0] != operator:
+            data.mark_changed(name)
+        elif operator == '$inc':
+            data.operators[name] = (operator, current[1] + values)
+        elif operator in ('$set', '$unset'):
+            current[1].update(values)
+        else:
+            current[1].extend(values)
+
+    def inc(self, name, amount=1):
+        """
+        Increments a numeric field, flushed as $inc so concurrent increments are not lost.
+        """
+        data = self.__dict__
+        if name not in data and data.lazy is not None:
+            # decode the current value first
+            getattr(self, name, None)
+        dict.__setitem__(data, name, data.get(name, 0) + amount)
+        self.record_operator(name, '$inc', amount)
+
+    def flush_operation(self):
+        """
+        New objects are inserted, the others are updated with their changes.
+
+        :return: the pymongo write operation used when flushing the object in bulk, None if nothing changed.
+        """
+        payload = self.flush_payload()
+        if payload is None:
+            return None
+        return InsertOne(payload) if self.__dict__.new else UpdateOne({'_id': self._id}, payload)
+
+    def flush_payload(self):
+        """
+        The payload is a copy: motor encodes it once the write is awaited, while the object may keep changing.
+
+        :return: the document to insert if the object is new, else its update document, None if nothing changed.
+        """
+        payload = dict(self.__dict__) if self.__dict__.new else self.flush_update()
+        return None if payload is None else deepcopy(payload)
+
+    @property
+    def state(self):
+        """ :return: the lifecycle state of the object: TRANSIENT, PENDING, PERSISTENT or DETACHED. """
+        if self.__dict__.new:
+            return PENDING if self in self.__class__.to_flush else TRANSIENT
+        session = self.__class__.session
+        if session.identity_map is None or session.lookup(self.__class__, self._id) is self:
+            return PERSISTENT
+        return DETACHED
 
     async def flush(self, check_integrity=True):
         """
-        Update the single document by writing its properties to the database.
+        Insert the document of a new object or update the single document by writing its changed properties
+        to the database. Clean objects are skipped.
         Disable check_integrity if you need additional performance, at your own risk!
         """
         if check_integrity:
-            field_properties = self.field_properties
-            for key, value in self.__dict__.items():
-                if key not in field_properties:
-                    raise AttributeError(self.__messages__['err_missing_attribute'] % key)
-
-                attribute_type = type(value)
-                if attribute_type is not field_properties[key].data_type:
-                    raise TypeError(self.__messages__['err_unexpected_attribute'] % (
-                        key, attribute_type, field_properties[key].data_type))
+            self.check_integrity()
+
+        if self.session.write_buffer is not None:
+            await self.session.write_buffer.add(self)
+            return
+
+        data = self.__dict__
+        new = data.new
+        payload = self.flush_payload()
+        changes = data.take_changes()
+        try:
+            if new:
+                await self.collection.insert_one(payload)
+            elif payload is not None:
+                await self.collection.update_one({'_id': self._id}, payload)
+        except BaseException:
+            data.restore_changes(changes)
+            raise
+        self.flushed(changes)
+
+    def flushed(self, changes=None):
+        """
+        Called once the object is written: it is now persistent and known to the session.
 
-        await self.collection.update_one({'_id': self._id}, {'$set': self.__dict__}, upsert=True)
-        self.clear()
+        :param changes: the changes written, taken with DataDict.take_changes: the object stays in the
+        flushing list if it was changed while the write was awaited. When None the object is now clean.
+        """
+        data = self.__dict__
+        if changes is None:
+            data.mark_clean()
+        data.new = False
+        self.session.remember(self)
+        # buffered writes invalidate the cache once they are written
+        if self.__class__.cache is not None and self.session.write_buffer is None:
+            self.__class__.cache.delete(self._id)
+        if data.has_changes:
+            self.attach()
+        else:
+            self.clear()
 
     @classmethod
     def clear_all(cls):
-        """ Remove all objects from the flushing list. """
+        """ Remove all objects of this model from the flushing list. """
         for obj in cls.to_flush:
-            cls.to_flush.remove(obj)
+            if isinstance(obj, cls):
+                cls.to_flush.discard(obj)
 
     def clear(self):
         """ Remove object from the flushing list. """
-        self.__class__.to_flush.remove(self)
+        self.detach()
 
     @classmethod
     async def create_indexes(cls):
@@ -90,11 +471,10 @@ class MetaModel:
             for index in cls.unique_indexes:
                 await cls.collection.create_index(index, unique=True)
 
-    @property
-    def field_properties(self):
-        return {key: value
-                for key, value in self.__class__.__dict__.items()
-                if type(value) is FieldProperty}
+    @classproperty
+    def field_properties(cls):
+        """ :return: read only mapping of field name -> FieldProperty, including inherited fields """
+        return cls.__schema__.fields
 
     def __init__(self, attached=False, **kwargs):
         """
@@ -111,35 +491,19 @@ class MetaModel:
         if type(self.__class__.session) is not DBSession:
             raise ValueError(self.__messages__['provide_valid_session'])
 
-        final_values = dict()
-
-        field_properties = self.field_properties
-
-        for fp_key, fp_value in self.field_properties.items():
-            # if some values are missing set them to their defaults
-            if fp_value.if_missing is not None and fp_key not in kwargs:
-                kwargs[fp_key] = fp_value.if_missing() if callable(fp_value.if_missing) else fp_value.if_missing
-
-            # check if attributes are missing
-            if fp_value.required and fp_key not in kwargs:
-                raise AttributeError(self.__messages__['missing_attribute'] % fp_key)
-
-        for key, value in kwargs.items():
-            if key in field_properties:
-                # validate the data type of each field
-                value_type = type(value)
-                if field_properties[key].data_type is not value_type:
-                    raise TypeError(self.__messages__['types_do_not_match'] % (
-                        key, value_type, field_properties[key].data_type))
-                final_values[key] = value
+        # fill defaults, check required fields and data types
+        final_values = self.__construct__(kwargs)
 
         # check for _id of type(ObjectId)
         if '_id' not in final_values and type(kwargs.get('_id', None)) is not ObjectId:
             raise AttributeError(self.__messages__['missing_id_field'] % ObjectId)
 
         # notifying dict!
-        self.__dict__ = DataDict()
+        object.__setattr__(self, '__dict__', DataDict())
         # save final values when all checks pass
+        for key in self.__class__.__schema__.tracked:
+            if key in final_values:
+                final_values[key] = self.track(key, final_values[key])
         self.__dict__.update(final_values)
 
         if attached:
@@ -152,26 +516,42 @@ class MetaModel:
 
     def data_set_changed(self):
         """ If an update should be issued. mak the object to be flushed. """
-        if self not in self.__class__.to_flush and hasattr(self.__dict__, 'attach_enabled'):
+        if hasattr(self.__dict__, 'attach_enabled'):
             self.attach()
 
     def attach(self):
         """ Add the current object to the to_flush list. """
-        if self not in self.__class__.to_flush:
-            self.__class__.to_flush.append(self)
+        self.__class__.to_flush.add(self)
+        auto_flusher = self.__class__.session.auto_flusher
+        if auto_flusher is not None:
+            auto_flusher.notify(self.__class__)
 
     def detach(self):
         """ Remove the current object from the to_flush list. """
-        if self in self.__class__.to_flush:
-            self.__class__.to_flush.remove(self)
+        self.__class__.to_flush.discard(self)
 
     def __setattr__(self, key, value):
+        tracked = key in self.__class__.__schema__.tracked
+        if tracked and self.__dict__.get(key) is value and isinstance(value, TrackedValue) \
+                and value.is_bound_to(self, key):
+            # in place operators, e.g. +=, assign back the value whose changes are already recorded
+            return
         self.data_set_changed()
+        if tracked:
+            value = self.track(key, value)
         super(MetaModel, self).__setattr__(key, value)
+        self.__dict__.mark_changed(key)
 
     def __delattr__(self, item):
+        if item not in self.__dict__ and self.__dict__.lazy is not None:
+            # decode the field first so it can be removed
+            getattr(self, item, None)
         self.data_set_changed()
         super(MetaModel, self).__delattr__(item)
+        self.__dict__.mark_deleted(item)
+        if self.__dict__.lazy is not None:
+            # the raw document must not bring the deleted value back
+            self.__dict__.lazy.discard(item)
 
     def __str__(self):
         return "<%s, %s>" % (self.__class__.__name__, self.__dict__)
@@ -183,39 +563,439 @@ class MetaModel:
         """
         return cls.session.database[cls.__model__]
 
+    @classproperty
+    def read_collection(cls):
+        """
+        :return: the motor collection object used by queries, returning raw BSON documents
+        when raw_documents is True
+        """
+        if cls.raw_documents:
+            return cls.collection.with_options(codec_options=CodecOptions(document_class=RawBSONDocument))
+        return cls.collection
+
     @classmethod
-    async def get(cls, _id, attached=False):
+    async def get(cls, _id, attached=False, batched=None, fields=None):
         """
          Returnes a mapped class instance of the found object.
+         Objects already held by the session identity map or by the model cache are returned without a query.
 
         :param attached: when True the object is automatically added to the to_flush list.
         :param _id: ObjectId of the element in the collection.
+        :param batched: when True the query is coalesced with other concurrent get() calls,
+        defaults to the model batch_get.
+        :param fields: names of the fields to load, None to load the whole document.
         :return:
         """
-        result = await cls.collection.find_one({'_id': _id})
-        return None if result is None else cls(**result, attached=attached)
+        obj = cls.get_cached(_id, attached=attached, fields=fields)
+        if obj is not None:
+            return obj
+
+        cache = cls.cache
+        if fields is not None:
+            result = await cls.read_collection.find_one({'_id': _id}, cls.projection(fields))
+            return None if result is None else cls.from_db(result, attached=attached, fields=fields)
+
+        if batched is None:
+            batched = cls.batch_get
+        if batched:
+            result = await cls.session.loader(cls).load(_id)
+        else:
+            result = await cls.read_collection.find_one({'_id': _id})
+        if result is None:
+            return None
+        if cache is not None:
+            cache.set(_id, deepcopy(result))
+        return cls.from_db(result, attached=attached)
+
+    @classmethod
+    def get_cached(cls, _id, attached=False, fields=None):
+        """
+        :param fields: names of the fields which must be loaded, None for the whole document.
+        :return: the instance held by the session identity map or built from the model cache,
+        None if the document would require a query.
+        """
+        obj = cls.session.lookup(cls, _id)
+        if obj is not None and obj.is_loaded(fields):
+            if attached:
+                obj.attach()
+            return obj
+
+        if cls.cache is not None:
+            document = cls.cache.get(_id)
+            if document is not None:
+                # cached documents are copied so instances never share mutable values
+                return cls.from_db(deepcopy(document), attached=attached)
+        return None
+
+    @classmethod
+    async def get_many(cls, ids, chunk_size=1000, max_concurrency=4, attached=False):
+        """
+        Returns the mapped class instances of the documents with the given ids.
+        Ids not found in the identity map or in the cache are queried with chunked $in queries,
+        issued concurrently.
+
+        :param ids: iterable of ObjectId.
+        :param chunk_size: maximum number of ids sent with a single query.
+        :param max_concurrency: maximum number of queries running at the same time.
+        :param attached: when True the objects are automatically added to the to_flush list.
+        :return: tuple (objects, missing ids), objects follow the order of ids with None for the missing ones.
+        """
+        if chunk_size < 1:
+            raise ValueError(cls.__messages__['invalid_batch_size'] % chunk_size)
+        if max_concurrency < 1:
+            raise ValueError("max_concurrency must be a positive integer, got %s" % max_concurrency)
+
+        ids = list(ids)
+        found = dict()
+        to_query = OrderedDict()
+        for _id in ids:
+            if _id in found or _id in to_query:
+                continue
+            obj = cls.get_cached(_id, attached=attached)
+            if obj is not None:
+                found[_id] = obj
+            else:
+                to_query[_id] = None
+
+        semaphore = asyncio.Semaphore(max_concurrency)
+
+        async def query(chunk):
+            async with semaphore:
+                documents = deque()
+                cursor = cls.read_collection.find({'_id': {'$in': chunk}})
+                while await cursor.fetch_next:
+                    documents.append(cursor.next_object())
+                return documents
+
+        to_query = list(to_query.keys())
+        chunks = [to_query[start:start + chunk_size] for start in range(0, len(to_query), chunk_size)]
+        for documents in await asyncio.gather(*(query(chunk) for chunk in chunks)):
+            for document in documents:
+                if cls.cache is not None:
+                    cls.cache.set(document['_id'], deepcopy(document))
+                found[document['_id']] = cls.from_db(document, attached=attached)
+
+        objects = [found.get(_id) for _id in ids]
+        missing = [_id for _id, obj in zip(ids, objects) if obj is None]
+        return objects, missing
+
+    @classmethod
+    def projection(cls, fields):
+        """ :return: the projection loading the given fields, _id is always loaded. """
+        projection = {'_id': True}
+        for name in fields:
+            if name not in cls.__schema__.fields:
+                raise AttributeError(cls.__messages__['unknown_field'] % name)
+            projection[name] = True
+        return projection
+
+    def is_loaded(self, fields=None):
+        """
+        :param fields: names of the fields to check, None to check the whole document.
+        :return: True if the fields were loaded from the database.
+        """
+        loaded = self.__dict__.loaded
+        return loaded is None or fields is not None and loaded.issuperset(fields)
+
+    async def load(self, *fields):
+        """ Fetches the fields which were not loaded yet, all of them when no field is given. """
+        await self.__class__.load_fields([self], fields=fields if len(fields) > 0 else None)
+
+    @classmethod
+    async def load_fields(cls, objects, fields=None, chunk_size=1000):
+        """
+        Fetches the fields not loaded yet by partially loaded objects, with one $in query
+        every chunk_size objects.
+
+        :param objects: instances of the model.
+        :param fields: names of the fields to load, None to complete the documents.
+        """
+        requested = cls.__schema__.fields.keys() if fields is None else cls.projection(fields).keys()
+        objects = [obj for obj in objects if not obj.is_loaded(requested)]
+
+        missing = set()
+        for obj in objects:
+            missing.update(name for name in requested if name not in obj.__dict__.loaded)
+        projection = cls.projection(missing)
+
+        for start in range(0, len(objects), chunk_size):
+            chunk = {obj._id: obj for obj in objects[start:start + chunk_size]}
+            cursor = cls.collection.find({'_id': {'$in': list(chunk.keys())}}, projection)
+            while await cursor.fetch_next:
+                document = cursor.next_object()
+                chunk[document['_id']].merge_document(document, requested)
+
+    def merge_document(self, document, fields=None):
+        """
+        Adds to a partially loaded object the fields of a document loaded from the database,
+        fields already loaded, set or deleted are kept as they are.
+
+        :param fields: names of the fields loaded in the document, None for the whole document.
+        """
+        data = self.__dict__
+        if data.loaded is None:
+            return
+
+        schema_fields = self.__class__.__schema__.fields
+        for name in schema_fields.keys() if fields is None else fields:
+            if name in data.loaded:
+                continue
+            if name in data.changed or name in data.deleted or name in data.operators:
+                # the changes made on the object win over the stored values
+                data.loaded.add(name)
+                continue
+            if name in document:
+                dict.__setitem__(data, name, self.track(name, document[name]))
+            elif name in schema_fields and schema_fields[name].if_missing is not None:
+                if_missing = schema_fields[name].if_missing
+                dict.__setitem__(data, name, self.track(name, if_missing() if callable(if_missing) else if_missing))
+                data.mark_changed(name)
+            data.loaded.add(name)
+
+        if data.loaded.issuperset(schema_fields):
+            data.loaded = None
+
+    @classmethod
+    def from_db(cls, document, attached=False, validate=None, fields=None):
+        """
+        Maps a document loaded from the database to a class instance.
+        If the session identity map already holds an instance for the document _id, that
+        instance is returned instead, only completed with the fields it did not load yet.
+        The document is trusted: model and session checks are skipped and, unless validated,
+        so are required and data type checks, which are then deferred to flush(check_integrity=True).
+        Only the fields filled in with their defaults are tracked as changed.
+        Raw BSON documents which are not validated are decoded one field at a time, on first access.
+
+        :param document: dict or RawBSONDocument returned by the database.
+        :param attached: when True the object is automatically added to the to_flush list.
+        :param validate: True to validate the document as __init__ does, False to trust it,
+        None to validate a random load_validation_rate sample of the documents.
+        :param fields: names of the fields loaded in the document when a projection was used.
+        """
+        loaded = cls.loaded_fields(fields)
+        lazy = None
+        if type(document) is RawBSONDocument:
+            lazy = LazyDocument(document.raw)
+            _id = lazy.decode('_id') if '_id' in lazy else None
+        else:
+            _id = document.get('_id')
+
+        obj = cls.session.lookup(cls, _id)
+        if obj is not None:
+            obj.merge_document(document, loaded)
+            if attached:
+                obj.attach()
+            return obj
+
+        if validate is None:
+            validate = cls.sample_validation()
+
+        if validate:
+            # validated raw documents are decoded upfront
+            lazy = None
+
+        if lazy is not None:
+            values = {'_id': _id}
+            for name, if_missing, is_factory in cls.__schema__.defaults:
+                if name not in lazy and (loaded is None or name in loaded):
+                    values[name] = if_missing() if is_factory else if_missing
+            return cls.from_values(values, values.keys() - lazy.keys(), loaded, lazy, attached)
+
+        values = cls.load_values(document, validate, loaded)
+        return cls.from_values(values, values.keys() - document.keys(), loaded, None, attached)
+
+    @classmethod
+    def loaded_fields(cls, fields):
+        """ :return: set of the fields loaded by a query projecting the given fields, None if all are loaded. """
+        if fields is None:
+            return None
+        loaded = set(cls.projection(fields).keys())
+        return None if loaded.issuperset(cls.__schema__.fields) else loaded
+
+    @classmethod
+    def sample_validation(cls):
+        """ :return: True if a loaded document should be validated, according to load_validation_rate. """
+        rate = cls.load_validation_rate
+        return rate > 0 and (rate >= 1 or random() < rate)
+
+    @classmethod
+    def load_values(cls, document, validate=False, loaded=None):
+        """
+        Builds the field values of a decoded document, filling in the defaults.
+        Does not use the session, so documents can be loaded outside of the event loop.
+
+        :param validate: True to validate the document as __init__ does.
+        :param loaded: set of the fields loaded in the document, None for the whole document.
+        :return: dict of field name -> value
+        """
+        if loaded is None:
+            return cls.__construct__(document) if validate else cls.__load__(document)
+        # defaults and required checks do not apply to the fields which were not loaded
+        values = {key: value for key, value in cls.__load__(document).items() if key in loaded}
+        if validate:
+            cls.__validate__(values)
+        return values
 
     @classmethod
-    async def to_mapped_list(cls, cursor, attached=False):
+    def from_values(cls, values, changed, loaded=None, lazy=None, attached=False):
+        """
+        Creates the object of values built by load_values and adds it to the session identity map.
+
+        :param changed: names of the fields filled in with their defaults, tracked as changed.
+        :param loaded: set of the fields loaded, None for the whole document.
+        :param lazy: LazyDocument decoding the fields missing from values on first access.
+        """
+        obj = cls.__new__(cls)
+        data = DataDict(values)
+        data.changed.update(changed)
+        data.loaded = loaded
+        data.lazy = lazy
+        data.new = False
+        object.__setattr__(obj, '__dict__', data)
+
+        for key in cls.__schema__.tracked:
+            if key in data:
+                dict.__setitem__(data, key, obj.track(key, data[key]))
+
+        if attached:
+            obj.attach()
+
+        # set callback to update object
+        data.set_callback(obj.data_set_changed)
+        data.attach_enabled = True
+
+        cls.session.remember(obj)
+        return obj
+
+    @classmethod
+    async def to_mapped_list(cls, cursor, attached=False, fields=None):
         """
         Maps each entry in the cursor to a mapped class instance.
 
         :param attached: when True the object is automatically added to the to_flush list.
         :param cursor:
+        :param fields: names of the fields projected by the cursor, None if documents are complete.
         :return: list of database mapped objects
         """
         results = deque()
         while await cursor.fetch_next:
-            results.append(cls(**cursor.next_object(), attached=attached))
+            results.append(cls.from_db(cursor.next_object(), attached=attached, fields=fields))
         return results
 
     @classmethod
-    async def find(cls, *args, attached=False):
+    async def find(cls, *args, attached=False, fields=None, offload=False, executor=None,
+                   max_in_flight=DEFAULT_MAX_IN_FLIGHT, prefetch=False, **find_kwargs):
         """
         Executes a find on the collection and returns a list of mapped class instances.
 
         :param args: list of parameters sent to the collection.find
+        :param find_kwargs: options sent to the collection.find, e.g. sort, limit or max_time_ms.
+        :param fields: names of the fields to load, None to load whole documents.
+        :param offload: when True the batches are decoded by the executor instead of the event loop,
+        see mlight.hydration.iter_offloaded.
+        :param prefetch: when True the next batch is fetched while the current one is hydrated,
+        see prefetch_cursor().
         :return: list of database mapped objects
         """
-        cursor = cls.collection.find(*args)
-        return await cls.to_mapped_list(cursor, attached=attached)
+        if prefetch and not offload:
+            cursor = cls.prefetch_cursor(*args, attached=attached, fields=fields, **find_kwargs)
+            return deque(await cursor.to_list())
+        if offload:
+            results = deque()
+            async for obj in iter_offloaded(cls, *args, attached=attached, fields=fields, executor=executor,
+                                            max_in_flight=max_in_flight, **find_kwargs):
+                results.append(obj)
+            return results
+        cursor = cls.read_collection.find(*args, **cls.find_options(fields, **find_kwargs))
+        return await cls.to_mapped_list(cursor, attached=attached, fields=fields)
+
+    @classmethod
+    def query(cls, *filters, **equalities):
+        """
+        :param filters: filter documents, validated against the model fields.
+        :param equalities: field=value conditions.
+        :return: an immutable, chainable Query of the model.
+        """
+        return Query(cls).filter(*filters, **equalities)
+
+    @classmethod
+    def prefetch_cursor(cls, *args, batch_size=None, attached=False, fields=None, **find_kwargs):
+        """
+        Executes a find on the collection returning raw BSON batches, wrapped in a PrefetchCursor which
+        requests the next batch while the current one is hydrated.
+        Without batch_size the session BatchSizer of the model picks it from the previous queries.
+
+        :return: PrefetchCursor yielding mapped instances
+        """
+        sizer = cls.session.batch_sizer(cls)
+        if batch_size is None:
+            batch_size = sizer.batch_size
+        cursor = cls.collection.find_raw_batches(*args, **cls.find_options(fields, **find_kwargs))
+        if batch_size is not None:
+            cursor.batch_size(batch_size)
+        return PrefetchCursor(cls, cursor, loaded=cls.loaded_fields(fields), attached=attached, sizer=sizer)
+
+    @classmethod
+    def find_options(cls, fields, **options):
+        """ :return: the keyword arguments of collection.find loading the given fields, with the other options. """
+        if fields is not None:
+            options['projection'] = cls.projection(fields)
+        return options
+
+    @classmethod
+    async def iter(cls, *args, batch_size=None, attached=False, fields=None, offload=False, executor=None,
+                   max_in_flight=DEFAULT_MAX_IN_FLIGHT, prefetch=False, **find_kwargs):
+        """
+        Executes a find on the collection and lazily yields mapped class instances,
+        only one batch of documents is held in memory at a time.
+        Breaking out of the loop closes the cursor once the generator is closed or collected,
+        use aclose() to close it right away.
+
+            async for obj in Model.iter({'age': 3}, batch_size=100):
+                ...
+
+        :param args: list of parameters sent to the collection.find
+        :param find_kwargs: options sent to the collection.find, e.g. sort, limit or max_time_ms.
+        :param batch_size: number of documents fetched with each round trip.
+        :param attached: when True the objects are automatically added to the to_flush list.
+        :param fields: names of the fields to load, None to load whole documents.
+        :param offload: when True the batches are decoded by the executor, at most max_in_flight at a time,
+        while the event loop keeps fetching the next ones. Raw documents are decoded upfront in this mode.
+        :param executor: concurrent.futures executor, None for the default thread pool of the loop.
+        :param prefetch: when True the next batch is fetched while the current one is hydrated on the loop,
+        the batch size adapts to the previous queries when not given. Offloading already reads ahead.
+        """
+        if offload:
+            async for obj in iter_offloaded(cls, *args, batch_size=batch_size, attached=attached, fields=fields,
+                                            executor=executor, max_in_flight=max_in_flight, **find_kwargs):
+                yield obj
+            return
+        if prefetch:
+            async for obj in cls.prefetch_cursor(*args, batch_size=batch_size, attached=attached, fields=fields,
+                                                 **find_kwargs):
+                yield obj
+            return
+
+        cursor = cls.read_collection.find(*args, **cls.find_options(fields, **find_kwargs))
+        if batch_size is not None:
+            cursor.batch_size(batch_size)
+        try:
+            while await cursor.fetch_next:
+                yield cls.from_db(cursor.next_object(), attached=attached, fields=fields)
+        finally:
+            await cursor.close()
+
+    @classmethod
+    async def find_columns(cls, filter=None, fields=None, batch_size=None, as_arrow=False):
+        """
+        Executes a find on the collection and returns the requested fields as typed numpy
+        masked arrays, or as an Arrow table, skipping the creation of mapped instances.
+        Requires numpy, and pyarrow for Arrow tables.
+
+        :param filter: query filter, None to match every document.
+        :param fields: names of the fields to return, defaults to every field of the model.
+        :param batch_size: number of documents fetched with each round trip and converted at once.
+        :param as_arrow: when True returns a pyarrow.Table.
+        :return: dict of field name -> numpy masked array, missing values are masked
+        """
+        return await find_columns(cls, filter=filter, fields=fields, batch_size=batch_size, as_arrow=as_arrow)
@@ -0,0 +1,107 @@
+"""
+Read-ahead over raw batch cursors: the next batch is requested from the server while the current one
+is hydrated, so network waits and object creation overlap.
+"""
+import asyncio
+from time import perf_counter
+
+from mlight.hydration import load_batch, map_batch
+
+
+class BatchSizer:
+    """
+    Picks the batch size of the queries of a model from the document size and the hydration throughput
+    observed on the previous batches: batches are kept under target_bytes and are hydrated in about
+    target_seconds, long enough for the next batch to arrive in the meantime and short enough not to block
+    the event loop. The batch size of a running cursor cannot be changed, it applies to the next queries.
+    """
+
+    def __init__(self, target_bytes=4 * 1024 * 1024, target_seconds=0.05, min_size=16, max_size=10000,
+                 smoothing=0.3):
+        """
+        :param smoothing: weight, between 0 and 1, of the last batch in the moving averages.
+        """
+        self.target_bytes = target_bytes
+        self.target_seconds = target_seconds
+        self.min_size = min_size
+        self.max_size = max_size
+        self.smoothing = smoothing
+        # moving averages of the document size in bytes and of the documents hydrated per second
+        self.document_size = None
+        self.rate = None
+
+    def _average(self, current, value):
+        return value if current is None else current + self.smoothing * (value - current)
+
+    def observe(self, count, size, seconds):
+        """ Records a batch of count documents, size bytes long, hydrated in seconds. """
+        if count == 0:
+            return
+        self.document_size = self._average(self.document_size, size / count)
+        if seconds > 0:
+            self.rate = self._average(self.rate, count / seconds)
+
+    @property
+    def batch_size(self):
+        """ :return: the batch size of the next query, None to use the server default until a batch is seen. """
+        if self.document_size is None:
+            return None
+        size = self.target_bytes / max(self.document_size, 1)
+        if self.rate is not None:
+            size = min(size, self.rate * self.target_seconds)
+        return int(min(max(size, self.min_size), self.max_size))
+
+
+class PrefetchCursor:
+    """
+    Wraps a raw batch cursor of a model and yields mapped instances, requesting the next batch
+    as soon as the current one is taken:
+
+        cursor = PrefetchCursor(Model, Model.collection.find_raw_batches({'age': 3}))
+        async for obj in cursor:
+            ...
+    """
+
+    def __init__(self, model, cursor, loaded=None, attached=False, sizer=None):
+        """
+        :param cursor: motor raw batch cursor returned by find_raw_batches.
+        :param loaded: set of the fields projected by the cursor, None if documents are complete.
+        :param attached: when True the objects are automatically added to the to_flush list.
+        :param sizer: BatchSizer updated with the batches hydrated.
+        """
+        self.model = model
+        self.cursor = cursor
+        self.loaded = loaded
+        self.attached = attached
+        self.sizer = sizer
+
+    def __aiter__(self):
+        return self.iter()
+
+    async def iter(self):
+        """ Yields the instances, the cursor is closed once the generator ends or is closed. """
+        fetch = asyncio.ensure_future(self.cursor.fetch_next)
+        try:
+            while await fetch:
+                raw_batch = self.cursor.next_object()
+                # the getMore runs in the background while this batch is hydrated
+                fetch = asyncio.ensure_future(self.cursor.fetch_next)
+
+                start = perf_counter()
+                objects = map_batch(self.model, load_batch(self.model, raw_batch, self.loaded), self.loaded,
+                                    self.attached)
+                if self.sizer is not None:
+                    self.sizer.observe(len(objects), len(raw_batch), perf_counter() - start)
+                for obj in objects:
+                    yield obj
+        finally:
+            # the cursor cannot be closed while a getMore is running
+            await asyncio.wait([fetch])
+            if not fetch.cancelled():
+                # errors of a batch which was not consumed are not reported
+                fetch.exception()
+            await self.cursor.close()
+
+    async def to_list(self):
+        """ :return: list of the mapped instances. """
+        return [obj async for obj in self.iter()]
@@ -0,0 +1,195 @@
+"""
+Chainable queries built on the FieldProperty schema of a model:
+
+    adults = Person.query(age={'$gte': 18}).sort('-age', 'name').limit(10).max_time_ms(500)
+    async for person in adults.iter():
+        ...
+
+Queries are immutable, every method returns a new query, so they can be kept and reused across
+requests: the filter and the options are validated and compiled once.
+"""
+from pymongo import ASCENDING, DESCENDING
+
+# operators whose argument is a list of filters
+_LOGICAL_OPERATORS = ('$and', '$or', '$nor')
+
+
+class Query:
+    """
+    Immutable query of a model, field references are checked against the model schema when the query is built.
+    """
+    __slots__ = ["model", "_filter", "_sort", "_skip", "_limit", "_hint", "_batch_size", "_max_time_ms", "_fields",
+                 "_compiled"]
+
+    def __init__(self, model):
+        self.model = model
+        self._filter = dict()
+        self._sort = None
+        self._skip = 0
+        self._limit = 0
+        self._hint = None
+        self._batch_size = None
+        self._max_time_ms = None
+        self._fields = None
+        # (filter, find options) computed on first use
+        self._compiled = None
+
+    def _copy(self, **changes):
+        query = Query(self.model)
+        for name in self.__slots__[1:-1]:
+            setattr(query, name, changes.get(name, getattr(self, name)))
+        return query
+
+    def _check_field(self, path):
+        """ Embedded fields are checked up to their top level field. """
+        name = path.split('.', 1)[0]
+        if name not in self.model.__schema__.fields:
+            raise AttributeError(self.model.__messages__['unknown_field'] % name)
+
+    def _check_filter(self, filter):
+        if type(filter) is not dict:
+            raise TypeError("Filter must be a dict, got %s" % type(filter))
+        for key, value in filter.items():
+            if key in _LOGICAL_OPERATORS:
+                for sub_filter in value:
+                    self._check_filter(sub_filter)
+            elif not key.startswith('$'):
+                self._check_field(key)
+
+    def filter(self, *filters, **equalities):
+        """
+        :param filters: filter documents, combined with the current filter.
+        :param equalities: field=value conditions.
+        :return: a query matching the documents which match the current filter and the given ones.
+        """
+        combined = dict(self._filter)
+        for filter in filters + (equalities,):
+            self._check_filter(filter)
+            if len(combined.keys() & filter.keys()) > 0:
+                # conditions on the same keys are all kept
+                combined = {'$and': [combined, filter]}
+            else:
+                combined.update(filter)
+        return self._copy(_filter=combined)
+
+    def sort(self, *keys):
+        """
+        :param keys: field names, prefixed with '-' for descending order, or (name, direction) tuples.
+        :return: a query sorted by the given keys, replacing the current sort.
+        """
+        sort = []
+        for key in keys:
+            if type(key) is tuple:
+                name, direction = key
+            elif key.startswith('-'):
+                name, direction = key[1:], DESCENDING
+            else:
+                name, direction = key, ASCENDING
+            self._check_field(name)
+            sort.append((name, direction))
+        return self._copy(_sort=sort if len(sort) > 0 else None)
+
+    def skip(self, count):
+        """ :return: a query skipping the first count documents. """
+        if count < 0:
+            raise ValueError("Skip must be a non negative integer, got %s" % count)
+        return self._copy(_skip=count)
+
+    def limit(self, count):
+        """ :return: a query returning at most count documents, 0 for no limit. """
+        if count < 0:
+            raise ValueError("Limit must be a non negative integer, got %s" % count)
+        return self._copy(_limit=count)
+
+    def hint(self, index):
+        """ :param index: the index name or its list of (name, direction) keys. """
+        if type(index) is not str:
+            for name, _ in index:
+                self._check_field(name)
+            index = list(index)
+        return self._copy(_hint=index)
+
+    def batch_size(self, size):
+        """ :return: a query fetching size documents with each round trip. """
+        if size < 1:
+            raise ValueError(self.model.__messages__['invalid_batch_size'] % size)
+        return self._copy(_batch_size=size)
+
+    def max_time_ms(self, milliseconds):
+        """ :return: a query aborted by the server after the given time, None for no limit. """
+        return self._copy(_max_time_ms=milliseconds)
+
+    def fields(self, *names):
+        """ :return: a query loading only the given fields, no names to load whole documents. """
+        if len(names) == 0:
+            return self._copy(_fields=None)
+        # checks the names
+        self.model.projection(names)
+        return self._copy(_fields=list(names))
+
+    def compile(self):
+        """ :return: the filter and the keyword arguments of collection.find, computed once. """
+        if self._compiled is None:
+            options = dict()
+            if self._sort is not None:
+                options['sort'] = self._sort
+            if self._skip > 0:
+                options['skip'] = self._skip
+            if self._limit > 0:
+                options['limit'] = self._limit
+            if self._hint is not None:
+                options['hint'] = self._hint
+            if self._max_time_ms is not None:
+                options['max_time_ms'] = self._max_time_ms
+            self._compiled = (self._filter, options)
+        return self._compiled
+
+    def _count_options(self, limit):
+        options = dict()
+        if self._skip > 0:
+            options['skip'] = self._skip
+        if limit > 0:
+            options['limit'] = limit
+        if self._hint is not None:
+            options['hint'] = self._hint
+        if self._max_time_ms is not None:
+            options['maxTimeMS'] = self._max_time_ms
+        return options
+
+    async def iter(self, attached=False, **kwargs):
+        """
+        Lazily yields the mapped instances, see MetaModel.iter.
+
+        :param kwargs: execution options of MetaModel.iter, e.g. prefetch or offload.
+        """
+        filter, options = self.compile()
+        async for obj in self.model.iter(filter, batch_size=self._batch_size, attached=attached,
+                                         fields=self._fields, **dict(options, **kwargs)):
+            yield obj
+
+    def __aiter__(self):
+        return self.iter()
+
+    async def all(self, attached=False, **kwargs):
+        """ :return: list of the mapped instances, see MetaModel.find. """
+        filter, options = self.compile()
+        if self._batch_size is not None:
+            options = dict(options, batch_size=self._batch_size)
+        return await self.model.find(filter, attached=attached, fields=self._fields, **dict(options, **kwargs))
+
+    async def first(self, attached=False):
+        """ :return: the first mapped instance, None if no document matches. """
+        results = await self.limit(1).all(attached=attached)
+        return results[0] if len(results) > 0 else None
+
+    async def count(self):
+        """ :return: the number of matching documents, according to skip and limit. """
+        return await self.model.collection.count_documents(self._filter, **self._count_options(self._limit))
+
+    async def exists(self):
+        """ :return: True if at least one document matches. """
+        return await self.model.collection.count_documents(self._filter, **self._count_options(1)) > 0
+
+    def __repr__(self):
+        filter, options = self.compile()
+        return "<%s %s: %s %s>" % (self.__class__.__name__, self.model.__model__, filter, options)
@@ -1,14 +1,54 @@
-from collections import deque
+import asyncio
+from collections import deque, OrderedDict
+from weakref import WeakValueDictionary
 
 import motor.motor_asyncio
 
+from mlight.auto_flush import AutoFlusher
+from mlight.loader import BatchLoader
+from mlight.prefetch import BatchSizer
+from mlight.unit_of_work import UnitOfWork, current_unit_of_work
+from mlight.utils import FlushError
+from mlight.write_buffer import DEFAULT_MAX_BUFFERED_BYTES, WriteBuffer
+
+
+def _restore_changes(taken):
+    """ Tracks again the changes of the (object, changes) pairs whose writes were not committed. """
+    for obj, changes in taken:
+        obj.__dict__.restore_changes(changes)
+    taken.clear()
+
 
 class DBSession:
-    def __init__(self, mongo_uri, database_name):
+    def __init__(self, mongo_uri, database_name, identity_map=False, write_behind=None,
+                 max_buffered_bytes=DEFAULT_MAX_BUFFERED_BYTES):
+        """
+        :param identity_map: when True objects loaded or flushed through the session are kept,
+        weakly, by (model, _id) so loading the same document again returns the same instance.
+        Sessions live as long as the process: while an instance is referenced get() returns it
+        without querying the database, so it may be stale. Units of work have identity maps of their own.
+        :param write_behind: seconds the flushed writes are buffered and merged per document before being
+        written, None to write on flush. Call drain() before shutting down.
+        :param max_buffered_bytes: size of the buffered writes past which flushing waits for them to be written.
+        """
         self.mongo_uri = mongo_uri
         self.database_name = database_name
         self.client = motor.motor_asyncio.AsyncIOMotorClient(mongo_uri)
         self.registered_models = deque()
+        self.identity_map = WeakValueDictionary() if identity_map else None
+        # model -> BatchLoader coalescing its get() calls
+        self.loaders = dict()
+        # model -> BatchSizer picking the batch size of its prefetching queries
+        self.batch_sizers = dict()
+        self.write_buffer = None
+        if write_behind is not None:
+            self.write_buffer = WriteBuffer(write_behind, max_buffered_bytes=max_buffered_bytes)
+        # background AutoFlusher, see start_auto_flush()
+        self.auto_flusher = None
+        # flushes outside of units of work do not overlap, units lock their own flushes
+        self._flush_lock = asyncio.Lock()
+        # whether the server supports multi-document transactions, checked on the first transactional flush
+        self._supports_transactions = None
 
     @property
     def database(self):
@@ -20,6 +60,57 @@ class DBSession:
         if model not in self.registered_models:
             self.registered_models.append(model)
 
+    def _unit_of_work(self):
+        """ :return: the unit of work of the current context if it belongs to this session, else None. """
+        unit_of_work = current_unit_of_work()
+        return unit_of_work if unit_of_work is not None and unit_of_work.session is self else None
+
+    def current_identity_map(self):
+        """ :return: the identity map of the current unit of work if any, else the session one. """
+        unit_of_work = self._unit_of_work()
+        return self.identity_map if unit_of_work is None else unit_of_work.identity_map
+
+    def lookup(self, model, _id):
+        """ :return: the instance of model with the given _id held by the identity map, None if missing. """
+        identity_map = self.current_identity_map()
+        if identity_map is None:
+            return None
+        return identity_map.get((model, _id))
+
+    def remember(self, obj):
+        """ Adds the object to the identity map. """
+        identity_map = self.current_identity_map()
+        if identity_map is not None:
+            identity_map[(obj.__class__, obj._id)] = obj
+
+    def forget(self, obj):
+        """ Removes the object from the identity map. """
+        identity_map = self.current_identity_map()
+        if identity_map is not None and identity_map.get((obj.__class__, obj._id)) is obj:
+            del identity_map[(obj.__class__, obj._id)]
+
+    def clear_identity_map(self):
+        """ Forgets every object, following loads will return new instances. """
+        identity_map = self.current_identity_map()
+        if identity_map is not None:
+            identity_map.clear()
+
+    def loader(self, model):
+        """ :return: the BatchLoader of the model, created on first use with the model batch_get_window. """
+        loader = self.loaders.get(model)
+        if loader is None:
+            loader = BatchLoader(model, window=model.batch_get_window)
+            self.loaders[model] = loader
+        return loader
+
+    def batch_sizer(self, model):
+        """ :return: the BatchSizer of the model, created on first use. """
+        sizer = self.batch_sizers.get(model)
+        if sizer is None:
+            sizer = BatchSizer()
+            self.batch_sizers[model] = sizer
+        return sizer
+
     async def create_indexes(self):
         """
         Creates indexes on the registered collections.
@@ -33,10 +124,151 @@ class DBSession:
         for collection in self.registered_models:
             collection.clear_all()
 
-    async def flush_all(self, check_integrity=True):
+    async def flush_all(self, check_integrity=True, batch_size=None, ordered=True, concurrent=False,
+                        max_concurrency=4, transactional=False):
         """
         Stores the current modified items to the database.
+        Modified items are grouped per collection and written with chunked bulk_write calls.
+
         :param check_integrity: if False skips the mapping check on each document.
+        :param batch_size: maximum number of operations per bulk_write, defaults to the model default.
+        :param ordered: if False the server may apply the operations of a batch in any order.
+        :param concurrent: when True collections are flushed in parallel on the event loop.
+        :param max_concurrency: maximum number of collections flushed at the same time in concurrent mode,
+        keep it below the motor connection pool size.
+        :param transactional: when True all the writes are committed in a single multi-document transaction,
+        retried on transient errors, objects are marked as flushed only once it is committed.
+        Collections are flushed one after the other. Standalone servers do not support transactions,
+        plain bulk writes are issued instead.
+        :return: dict of collection name -> FlushResult
+        :raises FlushError: in concurrent mode, when at least one collection failed to flush.
+        """
+        kwargs = dict(check_integrity=check_integrity, ordered=ordered)
+        if batch_size is not None:
+            kwargs['batch_size'] = batch_size
+
+        unit_of_work = self._unit_of_work()
+        flush_lock = self._flush_lock if unit_of_work is None else unit_of_work._flush_lock
+        async with flush_lock:
+            groups = self.dirty_objects()
+            if transactional:
+                if self.write_buffer is not None:
+                    raise ValueError("Transactional flush is not available with write-behind enabled")
+                if len(groups) > 0 and await self.supports_transactions():
+                    return await self._flush_in_transaction(groups, kwargs)
+                concurrent = False
+            return await self._flush_groups(groups, kwargs, concurrent, max_concurrency)
+
+    async def supports_transactions(self):
+        """ :return: True if the server is a replica set member or a mongos, which support transactions. """
+        if self._supports_transactions is None:
+            response = await self.client.admin.command('isMaster')
+            self._supports_transactions = 'setName' in response or response.get('msg') == 'isdbgrid'
+        return self._supports_transactions
+
+    async def _flush_in_transaction(self, groups, kwargs):
+        # (object, changes) written by the current attempt, marked as flushed once it is committed
+        taken = []
+        kwargs = dict(kwargs, taken=taken)
+
+        async def write(client_session):
+            # with_transaction runs it again on transient errors, results are rebuilt each time
+            _restore_changes(taken)
+            kwargs['client_session'] = client_session
+            return await self._flush_groups(groups, kwargs, False, 1)
+
+        try:
+            async with await self.client.start_session() as client_session:
+                results = await client_session.with_transaction(write)
+        except BaseException:
+            _restore_changes(taken)
+            raise
+
+        for obj, changes in taken:
+            obj.flushed(changes)
+        return results
+
+    async def _flush_groups(self, groups, kwargs, concurrent, max_concurrency):
+        results = OrderedDict()
+        if not concurrent:
+            for collection_name, objects in groups.items():
+                results[collection_name] = await objects[0].__class__.bulk_flush(objects, **kwargs)
+            return results
+
+        if max_concurrency < 1:
+            raise ValueError("max_concurrency must be a positive integer, got %s" % max_concurrency)
+        semaphore = asyncio.Semaphore(max_concurrency)
+
+        async def flush_collection(objects):
+            async with semaphore:
+                return await objects[0].__class__.bulk_flush(objects, **kwargs)
+
+        outcomes = await asyncio.gather(*(flush_collection(objects) for objects in groups.values()),
+                                        return_exceptions=True)
+
+        # errors are reported in the same order the collections were scheduled
+        errors = OrderedDict()
+        for collection_name, outcome in zip(groups.keys(), outcomes):
+            if isinstance(outcome, BaseException):
+                errors[collection_name] = outcome
+            else:
+                results[collection_name] = outcome
+        if len(errors) > 0:
+            raise FlushError(errors, results)
+        return results
+
+    def unit_of_work(self, flush=True, **flush_kwargs):
+        """
+        :return: a UnitOfWork, use it with `async with` to track and flush only the objects changed
+        in the current context.
+        """
+        return UnitOfWork(self, flush=flush, **flush_kwargs)
+
+    def start_auto_flush(self, max_dirty=1000, interval=1.0, on_error=None, **flush_kwargs):
+        """
+        Starts flushing the registered models in the background, once max_dirty objects wait to be flushed
+        or every interval seconds. Must be stopped with stop_auto_flush().
+
+        :param on_error: called with the exception of each failed flush.
+        :param flush_kwargs: passed to flush_all.
+        :return: the AutoFlusher
+        """
+        if self.auto_flusher is None or not self.auto_flusher.running:
+            self.auto_flusher = AutoFlusher(self, max_dirty=max_dirty, interval=interval, on_error=on_error,
+                                            **flush_kwargs)
+            self.auto_flusher.start()
+        return self.auto_flusher
+
+    async def stop_auto_flush(self):
+        """
+        Flushes the objects still waiting and stops the background flushing.
+        With write-behind enabled call drain() afterwards to write the buffered operations.
+        """
+        auto_flusher, self.auto_flusher = self.auto_flusher, None
+        if auto_flusher is not None:
+            await auto_flusher.stop()
+
+    async def drain(self):
+        """
+        Writes the operations held by the write-behind buffer.
+
+        :return: dict of collection name -> FlushResult, empty when write-behind is disabled.
+        """
+        if self.write_buffer is None:
+            return OrderedDict()
+        return await self.write_buffer.drain()
+
+    def dirty_objects(self):
+        """
+        :return: dict of collection name -> list of objects of the registered models waiting to be flushed
         """
-        for obj in self.registered_models:
-            await obj.flush_all(check_integrity)
+        groups = OrderedDict()
+        seen = set()
+        for model in self.registered_models:
+            for collection_name, objects in model.dirty_objects().items():
+                group = groups.setdefault(collection_name, [])
+                for obj in objects:
+                    if id(obj) not in seen:
+                        seen.add(id(obj))
+                        group.append(obj)
+        return groups
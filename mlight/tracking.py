@@ -0,0 +1,178 @@
+"""
+Field values which record their in place changes, so they can be flushed with atomic update operators
+instead of sending the whole value again.
+Only top level mutations are tracked, changes nested inside the values are not detected.
+"""
+from weakref import ref
+
+
+class TrackedValue:
+    """
+    Base of the tracked containers: they belong to a field of a single model instance, changes
+    are reported to the instance while the value is still the one set on the field.
+    """
+    __slots__ = ()
+
+    def bind(self, owner, name):
+        self._owner = ref(owner)
+        self._name = name
+
+    def is_bound_to(self, owner, name):
+        return self._owner is not None and self._owner() is owner and self._name == name
+
+    def _current_owner(self):
+        owner = self._owner() if self._owner is not None else None
+        # values replaced on the instance must not report changes anymore
+        if owner is None or owner.__dict__.get(self._name) is not self:
+            return None
+        return owner
+
+    def _record(self, operator, values):
+        owner = self._current_owner()
+        if owner is not None:
+            owner.record_operator(self._name, operator, values)
+
+    def _replace(self):
+        """ The change has no atomic operator, the whole field is set. """
+        self._record(None, None)
+
+
+class TrackedList(TrackedValue, list):
+    """
+    List flushing append and extend as $push, add_to_set as $addToSet and pull as $pullAll,
+    every other change sets the whole list.
+    """
+    __slots__ = ["_owner", "_name"]
+
+    def __init__(self, values=(), owner=None, name=None):
+        list.__init__(self, values)
+        self._owner = None
+        self._name = name
+        if owner is not None:
+            self.bind(owner, name)
+
+    def append(self, value):
+        list.append(self, value)
+        self._record('$push', [value])
+
+    def extend(self, values):
+        values = list(values)
+        list.extend(self, values)
+        self._record('$push', values)
+
+    def __iadd__(self, values):
+        self.extend(values)
+        return self
+
+    def add_to_set(self, *values):
+        """ Appends the values which are not in the list yet. """
+        for value in values:
+            if value not in self:
+                list.append(self, value)
+        self._record('$addToSet', list(values))
+
+    def pull(self, *values):
+        """ Removes every occurrence of the values. """
+        list.__setitem__(self, slice(None), [item for item in self if item not in values])
+        self._record('$pullAll', list(values))
+
+    def _replacing(name):
+        method = getattr(list, name)
+
+        def replacing(self, *args, **kwargs):
+            result = method(self, *args, **kwargs)
+            self._replace()
+            return result
+
+        replacing.__name__ = name
+        replacing.__doc__ = method.__doc__
+        return replacing
+
+    insert = _replacing('insert')
+    remove = _replacing('remove')
+    pop = _replacing('pop')
+    clear = _replacing('clear')
+    sort = _replacing('sort')
+    reverse = _replacing('reverse')
+    __setitem__ = _replacing('__setitem__')
+    __delitem__ = _replacing('__delitem__')
+
+    del _replacing
+
+    def __imul__(self, count):
+        list.__imul__(self, count)
+        self._replace()
+        return self
+
+    def __reduce_ex__(self, protocol):
+        # copies are plain lists, they do not belong to any instance
+        return list, (list(self),)
+
+
+class TrackedDict(TrackedValue, dict):
+    """
+    Dict flushing key assignments as $set and key removals as $unset on the dotted path of the key,
+    every other change sets the whole dict.
+    """
+    __slots__ = ["_owner", "_name"]
+
+    def __init__(self, values=(), owner=None, name=None):
+        dict.__init__(self, values)
+        self._owner = None
+        self._name = name
+        if owner is not None:
+            self.bind(owner, name)
+
+    @staticmethod
+    def _is_path(key):
+        return type(key) is str and len(key) > 0 and '.' not in key and not key.startswith('$')
+
+    def __setitem__(self, key, value):
+        dict.__setitem__(self, key, value)
+        if self._is_path(key):
+            self._record('$set', {key: value})
+        else:
+            self._replace()
+
+    def __delitem__(self, key):
+        dict.__delitem__(self, key)
+        if self._is_path(key):
+            self._record('$unset', {key: ''})
+        else:
+            self._replace()
+
+    def update(self, *args, **kwargs):
+        for key, value in dict(*args, **kwargs).items():
+            self[key] = value
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self[key] = default
+        return dict.__getitem__(self, key)
+
+    def pop(self, key, *default):
+        if key in self:
+            value = dict.__getitem__(self, key)
+            del self[key]
+            return value
+        return dict.pop(self, key, *default)
+
+    def popitem(self):
+        result = dict.popitem(self)
+        self._replace()
+        return result
+
+    def clear(self):
+        dict.clear(self)
+        self._replace()
+
+    def __reduce_ex__(self, protocol):
+        # copies are plain dicts, they do not belong to any instance
+        return dict, (dict(self),)
+
+
+# tracked container used for each data type
+TRACKED_TYPES = {
+    list: TrackedList,
+    dict: TrackedDict,
+}
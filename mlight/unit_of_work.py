@@ -0,0 +1,78 @@
+import asyncio
+from contextvars import ContextVar
+from weakref import WeakValueDictionary
+
+from mlight.utils import WeakIdentitySet
+
+# unit of work of the current context, None outside of unit_of_work() blocks
+_current = ContextVar('mlight_unit_of_work', default=None)
+
+
+def current_unit_of_work():
+    """ :return: the UnitOfWork bound to the current context, None if there is none. """
+    return _current.get()
+
+
+class UnitOfWork:
+    """
+    Scope of dirty tracking bound to the current context with contextvars: objects changed within
+    `async with session.unit_of_work():` are tracked by the unit instead of the models to_flush list,
+    so concurrent tasks only flush their own objects. Tasks created inside the block share the unit.
+    With an identity map enabled session each unit has its own, instances are not shared between units.
+
+    On a clean exit the objects are flushed, when an exception is raised they are discarded from
+    the flushing list, their in memory changes are kept.
+    """
+
+    def __init__(self, session, flush=True, **flush_kwargs):
+        """
+        :param session: the DBSession used to flush the objects.
+        :param flush: if False the objects are not flushed on exit.
+        :param flush_kwargs: passed to DBSession.flush_all.
+        """
+        self.session = session
+        self.flush_on_exit = flush
+        self.flush_kwargs = flush_kwargs
+        # objects waiting to be flushed
+        self.objects = WeakIdentitySet()
+        # (model, _id) -> instance loaded or flushed within the unit, None when the session has no identity map
+        self.identity_map = WeakValueDictionary() if session.identity_map is not None else None
+        # flushes of the unit do not overlap, other units flush their own objects meanwhile
+        self._flush_lock = asyncio.Lock()
+        self._token = None
+
+    def __len__(self):
+        return len(self.objects)
+
+    async def __aenter__(self):
+        if self._token is not None:
+            raise RuntimeError("Unit of work already entered")
+        self._token = _current.set(self)
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        try:
+            if exc_type is None and self.flush_on_exit:
+                await self.flush()
+        finally:
+            _current.reset(self._token)
+            self._token = None
+            self.discard()
+
+    async def flush(self, **flush_kwargs):
+        """
+        Flushes the objects of the unit, can be called within the block.
+
+        :return: dict of collection name -> FlushResult
+        """
+        token = _current.set(self)
+        try:
+            return await self.session.flush_all(**dict(self.flush_kwargs, **flush_kwargs))
+        finally:
+            _current.reset(token)
+
+    def discard(self):
+        """ Forgets the objects of the unit without flushing them. """
+        self.objects = WeakIdentitySet()
+        if self.identity_map is not None:
+            self.identity_map = WeakValueDictionary()
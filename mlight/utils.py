@@ -1,3 +1,10 @@
+import struct
+from weakref import ref
+
+from bson import decode_all
+from bson.errors import InvalidBSON
+
+
 class classproperty(object):
     def __init__(self, getter):
         self.getter = getter
@@ -10,12 +17,23 @@ class DataDict(dict):
     """
     callback is invoked whenever update on the object is issued.
     attach_enabled is stored here, and will not figure as one of the paramters when flushing.
+    changed and deleted hold the keys set or removed since the last flush.
+    loaded holds the fields fetched from the database for partially loaded documents, None when complete.
+    lazy holds the LazyDocument whose fields are decoded on first access, None when decoded upfront.
+    new is True until the document is written to or loaded from the database.
+    operators holds the atomic operators recorded for tracked fields: field name -> (operator, values).
     """
-    __slots__ = ["callback", "attach_enabled"]
+    __slots__ = ["callback", "attach_enabled", "changed", "deleted", "loaded", "lazy", "new", "operators"]
 
     def __init__(self, *args, **kwargs):
         self.callback = None
         self.attach_enabled = False
+        self.changed = set()
+        self.deleted = set()
+        self.loaded = None
+        self.lazy = None
+        self.new = True
+        self.operators = dict()
         dict.__init__(self, *args, **kwargs)
 
     def set_callback(self, callback):
@@ -24,4 +42,287 @@ class DataDict(dict):
     def update(self, E=None, **F):
         if self.callback is not None:
             self.callback()
-        super(DataDict, self).update(E, **F)
+        if E is not None:
+            if not hasattr(E, 'keys'):
+                E = dict(E)
+            super(DataDict, self).update(E)
+            self.changed.update(E.keys())
+        super(DataDict, self).update(**F)
+        self.changed.update(F.keys())
+        self.deleted.difference_update(self.changed)
+        for key in self.changed.intersection(self.operators):
+            del self.operators[key]
+
+    def mark_changed(self, key):
+        """ Track a key which was set, its value is sent as a whole. """
+        self.changed.add(key)
+        self.deleted.discard(key)
+        self.operators.pop(key, None)
+
+    def mark_deleted(self, key):
+        """ Track a key which was removed. """
+        self.deleted.add(key)
+        self.changed.discard(key)
+        self.operators.pop(key, None)
+
+    def mark_clean(self, keys=None):
+        """ Stop tracking the given keys, or all keys when None. """
+        if keys is None:
+            self.changed.clear()
+            self.deleted.clear()
+            self.operators.clear()
+        else:
+            self.changed.difference_update(keys)
+            self.deleted.difference_update(keys)
+            for key in keys:
+                self.operators.pop(key, None)
+
+    def take_changes(self):
+        """
+        Stops tracking the changes a write is built from, the changes made while it is awaited are
+        tracked from scratch.
+
+        :return: (new, changed, deleted, operators) of the write, see restore_changes.
+        """
+        changes = (self.new, self.changed, self.deleted, self.operators)
+        self.new = False
+        self.changed = set()
+        self.deleted = set()
+        self.operators = dict()
+        return changes
+
+    def restore_changes(self, changes):
+        """ Tracks again the changes of a failed write, merged with the changes made since it was built. """
+        new, changed, deleted, operators = changes
+        if new:
+            # the whole document is inserted again
+            self.new = True
+            self.mark_clean()
+            return
+
+        for key, (operator, values) in operators.items():
+            if key in self.changed or key in self.deleted:
+                continue
+            current = self.operators.get(key)
+            if current is None:
+                self.operators[key] = (operator, values)
+            elif current[0] != operator:
+                self.mark_changed(key)
+            elif operator in ('$set', '$unset'):
+                merged = dict(values)
+                merged.update(current[1])
+                self.operators[key] = (operator, merged)
+            else:
+                self.operators[key] = (operator, values + current[1])
+        for key in changed:
+            # values changed in place since then are sent as a whole as well
+            if key not in self.deleted:
+                self.mark_changed(key)
+        for key in deleted:
+            if key in self.operators:
+                self.mark_changed(key)
+            elif key not in self.changed:
+                self.deleted.add(key)
+
+    @property
+    def has_changes(self):
+        return len(self.changed) > 0 or len(self.deleted) > 0 or len(self.operators) > 0
+
+
+# size of the BSON element values which do not depend on the content
+_BSON_FIXED_SIZES = {0x01: 8, 0x06: 0, 0x07: 12, 0x08: 1, 0x09: 8, 0x0A: 0, 0x10: 4, 0x11: 8, 0x12: 8, 0x13: 16,
+                     0x7F: 0, 0xFF: 0}
+_INT32 = struct.Struct('<i')
+
+
+def bson_element_offsets(raw):
+    """
+    Scans a raw BSON document without decoding its values.
+
+    :param raw: bytes of the BSON document.
+    :return: dict of element name -> (start, end) offsets of the whole element in raw
+    """
+    offsets = dict()
+    position = 4
+    end = len(raw) - 1
+    while position < end:
+        element_type = raw[position]
+        name_end = raw.index(b'\x00', position + 1)
+        value = name_end + 1
+
+        if element_type in _BSON_FIXED_SIZES:
+            size = _BSON_FIXED_SIZES[element_type]
+        elif element_type in (0x02, 0x0D, 0x0E):
+            # string, javascript code, symbol
+            size = 4 + _INT32.unpack_from(raw, value)[0]
+        elif element_type in (0x03, 0x04, 0x0F):
+            # document, array, code with scope
+            size = _INT32.unpack_from(raw, value)[0]
+        elif element_type == 0x05:
+            # binary: length, subtype and data
+            size = 5 + _INT32.unpack_from(raw, value)[0]
+        elif element_type == 0x0B:
+            # regular expression: pattern and options cstrings
+            size = raw.index(b'\x00', raw.index(b'\x00', value) + 1) + 1 - value
+        elif element_type == 0x0C:
+            # db pointer: string and ObjectId
+            size = 4 + _INT32.unpack_from(raw, value)[0] + 12
+        else:
+            raise InvalidBSON("unknown element type 0x%02x" % element_type)
+
+        offsets[bytes(raw[position + 1:name_end]).decode('utf-8')] = (position, value + size)
+        position = value + size
+    return offsets
+
+
+class LazyDocument:
+    """
+    Raw BSON document whose elements are decoded one at a time, when requested.
+    Elements are located on first use by scanning the document without decoding it.
+    """
+    __slots__ = ["raw", "_offsets"]
+
+    def __init__(self, raw):
+        self.raw = raw
+        self._offsets = None
+
+    @property
+    def offsets(self):
+        if self._offsets is None:
+            self._offsets = bson_element_offsets(self.raw)
+        return self._offsets
+
+    def __contains__(self, name):
+        return name in self.offsets
+
+    def keys(self):
+        return self.offsets.keys()
+
+    def discard(self, name):
+        """ Hides the element, e.g. once the field is deleted from the object. """
+        self.offsets.pop(name, None)
+
+    def decode(self, name):
+        """ :return: the decoded value of the element, raises KeyError if missing. """
+        start, end = self.offsets[name]
+        # wrap the single element in a document of its own
+        return decode_all(_INT32.pack(end - start + 5) + bytes(self.raw[start:end]) + b'\x00')[0][name]
+
+
+class WeakIdentitySet:
+    """
+    Insertion ordered set of weakly referenced objects compared by identity.
+    Membership, add and discard are O(1) and objects are dropped once garbage collected.
+    Iteration works on a snapshot, so the set can be modified while iterating it.
+    """
+    __slots__ = ["_refs"]
+
+    def __init__(self, items=()):
+        self._refs = dict()
+        for item in items:
+            self.add(item)
+
+    def _ref(self, item):
+        return self._refs.get(id(item))
+
+    def add(self, item):
+        current = self._ref(item)
+        if current is not None and current() is item:
+            return
+        key = id(item)
+        refs = self._refs
+
+        def remove(weak_ref):
+            # the id may have been reused by a new object in the meantime
+            if refs.get(key) is weak_ref:
+                del refs[key]
+
+        refs.pop(key, None)
+        refs[key] = ref(item, remove)
+
+    def discard(self, item):
+        current = self._ref(item)
+        if current is not None and current() is item:
+            del self._refs[id(item)]
+
+    def remove(self, item):
+        if item not in self:
+            raise KeyError(item)
+        self.discard(item)
+
+    def clear(self):
+        self._refs.clear()
+
+    def __contains__(self, item):
+        current = self._ref(item)
+        return current is not None and current() is item
+
+    def __iter__(self):
+        for weak_ref in list(self._refs.values()):
+            item = weak_ref()
+            if item is not None:
+                yield item
+
+    def __len__(self):
+        return len(self._refs)
+
+    def __bool__(self):
+        return len(self._refs) > 0
+
+
+class FlushResult:
+    """
+    Summary of the bulk writes issued on a single collection during a flush.
+    """
+
+    def __init__(self, collection_name):
+        self.collection_name = collection_name
+        self.batches = 0
+        self.inserted_count = 0
+        self.matched_count = 0
+        self.modified_count = 0
+        self.upserted_count = 0
+
+    def add(self, bulk_write_result):
+        """ Accumulates the counters of a pymongo BulkWriteResult. """
+        self.batches += 1
+        self.inserted_count += bulk_write_result.inserted_count
+        self.matched_count += bulk_write_result.matched_count
+        self.modified_count += bulk_write_result.modified_count
+        self.upserted_count += bulk_write_result.upserted_count
+
+    def __str__(self):
+        return "<%s %s: batches=%s, inserted=%s, matched=%s, modified=%s, upserted=%s>" % (
+            self.__class__.__name__, self.collection_name, self.batches, self.inserted_count,
+            self.matched_count, self.modified_count, self.upserted_count)
+
+
+class FlushError(Exception):
+    """
+    Raised when one or more collections fail to flush.
+    errors maps each failed collection name to its exception, in flushing order,
+    results holds the FlushResult of the collections which were written successfully.
+    """
+
+    def __init__(self, errors, results):
+        self.errors = errors
+        self.results = results
+        super(FlushError, self).__init__("Failed to flush collections: %s" % ", ".join(
+            "'%s' (%s: %s)" % (name, type(error).__name__, error) for name, error in errors.items()))
+
+
+class InsertResult:
+    """
+    Summary of a bulk insert on a single collection.
+    errors holds (record index, error) tuples: the validation exception or the server write error document.
+    """
+
+    def __init__(self, collection_name):
+        self.collection_name = collection_name
+        self.batches = 0
+        self.inserted_count = 0
+        self.errors = []
+
+    def __str__(self):
+        return "<%s %s: batches=%s, inserted=%s, errors=%s>" % (
+            self.__class__.__name__, self.collection_name, self.batches, self.inserted_count, len(self.errors))
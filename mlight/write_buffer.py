@@ -0,0 +1,359 @@
+import asyncio
+from collections import OrderedDict
+from numbers import Number
+
+from bson import BSON
+from pymongo import InsertOne, UpdateOne
+from pymongo.errors import BulkWriteError
+
+from mlight.utils import FlushResult
+
+# bound on the size of the buffered operations, flushing waits for the buffer to be written past it
+DEFAULT_MAX_BUFFERED_BYTES = 16 * 1024 * 1024
+
+INSERT = 'insert'
+UPDATE = 'update'
+
+# markers used while merging values
+_MISSING = object()
+_UNSET = object()
+_UNMERGEABLE = object()
+
+
+def _apply(operator, current, argument):
+    """ :return: the value of a field after the update operator, _UNMERGEABLE if it cannot be computed. """
+    if operator == '$set':
+        return argument
+    if operator == '$unset':
+        return _UNSET
+    if operator == '$inc':
+        if current is _MISSING:
+            return argument
+        if isinstance(current, Number) and not isinstance(current, bool):
+            return current + argument
+        return _UNMERGEABLE
+
+    if current is _MISSING:
+        current = []
+    elif not isinstance(current, list):
+        return _UNMERGEABLE
+    if operator == '$push':
+        return current + argument['$each']
+    if operator == '$addToSet':
+        result = list(current)
+        for value in argument['$each']:
+            if value not in result:
+                result.append(value)
+        return result
+    if operator == '$pullAll':
+        return [value for value in current if value not in argument]
+    return _UNMERGEABLE
+
+
+def _apply_path(document, keys, operator, argument):
+    """ :return: a copy of the embedded document with the operator applied on the keys path. """
+    if not isinstance(document, dict):
+        return _UNMERGEABLE
+    document = dict(document)
+    key = keys[0]
+    if len(keys) > 1:
+        if key not in document:
+            return _UNMERGEABLE
+        value = _apply_path(document[key], keys[1:], operator, argument)
+    else:
+        value = _apply(operator, document.get(key, _MISSING), argument)
+
+    if value is _UNMERGEABLE:
+        return value
+    if value is _UNSET:
+        document.pop(key, None)
+    else:
+        document[key] = value
+    return document
+
+
+def _overlaps(path, other):
+    return path == other or path.startswith(other + '.') or other.startswith(path + '.')
+
+
+def _merge_path(update, operator, path, argument):
+    """
+    Merges a single operator argument into the update document, in place.
+
+    :return: False if the update cannot express both changes.
+    """
+    conflicts = [(op, p) for op, arguments in update.items() for p in arguments if _overlaps(p, path)]
+    if len(conflicts) == 0:
+        update.setdefault(operator, dict())[path] = argument
+        return True
+
+    # replacing a field overrides every earlier change of the field and of its embedded fields
+    if operator in ('$set', '$unset') and all(p == path or p.startswith(path + '.') for _, p in conflicts):
+        for op, p in conflicts:
+            del update[op][p]
+        update.setdefault(operator, dict())[path] = argument
+        return True
+
+    if len(conflicts) > 1:
+        return False
+    op, p = conflicts[0]
+    current = update[op][p]
+    if p == path and op == operator:
+        if operator == '$inc':
+            update[op][p] = current + argument
+        elif operator == '$pullAll':
+            update[op][p] = current + argument
+        elif operator in ('$push', '$addToSet'):
+            update[op][p] = {'$each': current['$each'] + argument['$each']}
+        else:
+            return False
+        return True
+
+    if op != '$set':
+        return False
+    if p == path:
+        value = _apply(operator, current, argument)
+    elif path.startswith(p + '.'):
+        value = _apply_path(current, path[len(p) + 1:].split('.'), operator, argument)
+    else:
+        return False
+
+    if value is _UNMERGEABLE:
+        return False
+    if value is _UNSET:
+        del update[op][p]
+        update.setdefault('$unset', dict())[p] = ''
+    else:
+        update[op][p] = value
+    return True
+
+
+def merge_updates(update, other):
+    """
+    Merges two update documents of the same document: $set and $unset are combined, $inc are summed and
+    array operators are concatenated, changes to fields already set are applied on the value.
+
+    :return: the merged update document, None if a single update cannot express both.
+    """
+    merged = {operator: dict(arguments) for operator, arguments in update.items()}
+    for operator, arguments in other.items():
+        for path, argument in arguments.items():
+            if not _merge_path(merged, operator, path, argument):
+                return None
+    return {operator: arguments for operator, arguments in merged.items() if len(arguments) > 0}
+
+
+def merge_into_document(document, update):
+    """
+    Applies an update document on a document which is not inserted yet.
+
+    :return: the updated document, None if the update cannot be applied without the database.
+    """
+    merged = merge_updates({'$set': document}, update)
+    if merged is None or len(set(merged.keys()) - {'$set', '$unset'}) > 0:
+        return None
+    # top level $unset only refer to fields missing from the document
+    return merged.get('$set', dict())
+
+
+class BufferedWrite:
+    """
+    The writes of a single document waiting in the buffer, consecutive writes are merged
+    whenever possible.
+    """
+    __slots__ = ["model", "_id", "operations", "size"]
+
+    def __init__(self, model, _id):
+        self.model = model
+        self._id = _id
+        # list of (INSERT, document) or (UPDATE, update document), in flushing order
+        self.operations = []
+        self.size = 0
+
+    def add(self, kind, payload):
+        if kind == UPDATE and len(self.operations) > 0:
+            last_kind, last = self.operations[-1]
+            if last_kind == INSERT:
+                merged = merge_into_document(last, payload)
+            else:
+                merged = merge_updates(last, payload)
+            if merged is not None:
+                self.operations[-1] = (last_kind, merged)
+                self.size = sum(len(BSON.encode(operation)) for _, operation in self.operations)
+                return
+        self.extend([(kind, payload)])
+
+    def extend(self, operations):
+        """ Appends (kind, payload) operations without merging them. """
+        for kind, payload in operations:
+            self.operations.append((kind, payload))
+            self.size += len(BSON.encode(payload))
+
+    def write_operation(self, kind, payload):
+        """ :return: the pymongo write operation of a buffered operation. """
+        return InsertOne(payload) if kind == INSERT else UpdateOne({'_id': self._id}, payload)
+
+    def write_operations(self):
+        """ :return: the pymongo write operations of the document. """
+        return [self.write_operation(kind, payload) for kind, payload in self.operations]
+
+
+class WriteBuffer:
+    """
+    Write-behind buffer of a DBSession: the objects flushed within the window are not written right away,
+    the writes of the same (model, _id) are merged and sent together with bulk_write once the window expires.
+    Objects are marked as flushed as soon as they are buffered, reads hitting the database do not see the
+    buffered changes until they are written, the model cache is invalidated once they are.
+    """
+
+    def __init__(self, window, max_buffered_bytes=DEFAULT_MAX_BUFFERED_BYTES, batch_size=1000):
+        """
+        :param window: seconds the writes are held in the buffer, measured from the first buffered write.
+        :param max_buffered_bytes: when the buffered operations reach this BSON size flushing waits
+        for the whole buffer to be written.
+        :param batch_size: maximum number of operations sent with a single bulk_write.
+        """
+        self.window = window
+        self.max_buffered_bytes = max_buffered_bytes
+        self.batch_size = batch_size
+        self.buffered_bytes = 0
+        # (model, _id) -> BufferedWrite
+        self._entries = OrderedDict()
+        self._handle = None
+        self._lock = asyncio.Lock()
+        # background writes in progress
+        self._tasks = set()
+        # first error raised by a background write, reported by the next add or drain
+        self._error = None
+
+    def __len__(self):
+        return len(self._entries)
+
+    async def add(self, obj):
+        """
+        Buffers the pending write of the object: its insert if new, else its update.
+        The object is marked as flushed right away, before waiting for the buffer to be written.
+        """
+        self._raise_error()
+        kind = INSERT if obj.__dict__.new else UPDATE
+        # a copy, the object keeps changing while the write waits in the buffer
+        payload = obj.flush_payload()
+        if payload is None:
+            obj.flushed()
+            return
+
+        key = (obj.__class__, obj._id)
+        entry = self._entries.get(key)
+        if entry is None:
+            entry = BufferedWrite(obj.__class__, obj._id)
+            self._entries[key] = entry
+        self.buffered_bytes -= entry.size
+        entry.add(kind, payload)
+        self.buffered_bytes += entry.size
+        # changes made while waiting for the backpressure are flushed with the next add
+        obj.flushed()
+
+        if self.buffered_bytes >= self.max_buffered_bytes:
+            # backpressure: the caller waits for the buffer to be written
+            await self.drain()
+        elif self._handle is None:
+            self._handle = asyncio.get_event_loop().call_later(self.window, self._write_in_background)
+
+    async def drain(self):
+        """
+        Writes the buffered operations now and waits for the background writes in progress.
+
+        :return: dict of collection name -> FlushResult of the operations written by this call
+        :raises: the first error of the writes, see write().
+        """
+        if self._handle is not None:
+            self._handle.cancel()
+            self._handle = None
+        try:
+            results = await self.write()
+        finally:
+            if len(self._tasks) > 0:
+                await asyncio.gather(*list(self._tasks))
+        self._raise_error()
+        return results
+
+    async def write(self):
+        """
+        Sends the buffered operations with bulk_write, grouped per collection, then invalidates the model cache
+        of the documents written.
+        When a write fails the operations not written yet are put back in the buffer and retried once the
+        window expires, except the operation rejected by the server, and the error is raised.
+        """
+        async with self._lock:
+            entries, self._entries = self._entries, OrderedDict()
+            self.buffered_bytes -= sum(entry.size for entry in entries.values())
+
+            groups = OrderedDict()
+            for entry in entries.values():
+                group = groups.setdefault(entry.model.__model__, (entry.model, []))
+                group[1].extend((entry, operation) for operation in entry.operations)
+
+            # (entry, operation) pairs in writing order, the first done of them are written or rejected
+            pending = [item for _, items in groups.values() for item in items]
+            done = 0
+            results = OrderedDict()
+            try:
+                for collection_name, (model, items) in groups.items():
+                    result = FlushResult(collection_name)
+                    results[collection_name] = result
+                    for start in range(0, len(items), self.batch_size):
+                        chunk = items[start:start + self.batch_size]
+                        try:
+                            result.add(await model.collection.bulk_write(
+                                [entry.write_operation(*operation) for entry, operation in chunk]))
+                        except BulkWriteError as e:
+                            write_errors = e.details.get('writeErrors', [])
+                            if len(write_errors) > 0:
+                                # the bulk_write is ordered: it stopped at the rejected operation
+                                done += min(write_error['index'] for write_error in write_errors) + 1
+                            raise
+                        done += len(chunk)
+            except Exception:
+                self._requeue(pending[done:])
+                raise
+            finally:
+                for entry in entries.values():
+                    if entry.model.cache is not None:
+                        entry.model.cache.delete(entry._id)
+            return results
+
+    def _requeue(self, items):
+        """ Puts back (entry, operation) pairs ahead of the operations buffered in the meantime. """
+        entries = OrderedDict()
+        for entry, operation in items:
+            key = (entry.model, entry._id)
+            if key not in entries:
+                entries[key] = BufferedWrite(entry.model, entry._id)
+            entries[key].extend([operation])
+        for key, entry in self._entries.items():
+            if key in entries:
+                entries[key].extend(entry.operations)
+            else:
+                entries[key] = entry
+        self._entries = entries
+        self.buffered_bytes = sum(entry.size for entry in entries.values())
+        if len(entries) > 0 and self._handle is None:
+            self._handle = asyncio.get_event_loop().call_later(self.window, self._write_in_background)
+
+    def _write_in_background(self):
+        self._handle = None
+        task = asyncio.ensure_future(self._background_write())
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _background_write(self):
+        try:
+            await self.write()
+        except Exception as e:
+            if self._error is None:
+                self._error = e
+
+    def _raise_error(self):
+        error, self._error = self._error, None
+        if error is not None:
+            raise error
@@ -5,9 +5,12 @@ here = os.path.abspath(os.path.dirname(__file__))
 
 install_requires = [
     "motor",
-    "weakreflist"
 ]
 
+extras_require = {
+    'columns': ['numpy', 'pyarrow'],
+}
+
 # test dependencies
 setup_requires = [
     'nose',
@@ -19,6 +22,7 @@ setup(
     version='0.0.1',
     packages=['mlight'],
     install_requires=install_requires,
+    extras_require=extras_require,
     setup_requires=setup_requires,
     test_suite="nose.collector",
 )
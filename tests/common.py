@@ -10,10 +10,10 @@ def loop_runner(async_function):
     loop.run_until_complete(async_function())
 
 
-def get_db_session(host='localhost', port=27017, database_name='mlight'):
+def get_db_session(host='localhost', port=27017, database_name='mlight', **kwargs):
     # create a new database name each time and use that one at the end drop it in the files
     name = "%s_%s" % (database_name, str(uuid.uuid4()).replace('-', '_'))
-    return DBSession('mongodb://%s:%s' % (host, port), name)
+    return DBSession('mongodb://%s:%s' % (host, port), name, **kwargs)
 
 
 def drop_database(db_session):
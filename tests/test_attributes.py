@@ -0,0 +1,73 @@
+from bson import ObjectId
+
+from mlight.attributes import FieldProperty, ModelSchema
+from mlight.meta_model import MetaModel
+
+MESSAGES = MetaModel.__messages__
+
+
+def get_schema():
+    return ModelSchema(dict(
+        _id=FieldProperty(ObjectId, if_missing=ObjectId),
+        name=FieldProperty(str, required=True, if_missing=''),
+        age=FieldProperty(int, required=True),
+        height=FieldProperty(float),
+    ))
+
+
+def expect_error(function, error_type, message):
+    try:
+        function()
+        assert False, 'test failed'
+    except error_type as e:
+        assert type(e) is error_type, 'error type mismatch'
+        assert str(e) == message, 'error message does not match'
+
+
+def test_compiled_construct_matches_generic():
+    schema = get_schema()
+    construct, _ = schema.compile(MESSAGES)
+    _id = ObjectId()
+
+    for kwargs in [dict(_id=_id, age=3), dict(_id=_id, age=3, height=1.5, name='name', extra=1)]:
+        assert construct(kwargs) == schema.construct(kwargs, MESSAGES), 'values do not match'
+    assert type(construct(dict(age=3))['_id']) is ObjectId, 'default factory should be called'
+
+
+def test_compiled_construct_errors():
+    schema = get_schema()
+    construct, _ = schema.compile(MESSAGES)
+
+    expect_error(lambda: construct(dict()), AttributeError, MESSAGES['missing_attribute'] % 'age')
+    expect_error(lambda: construct(dict(age='3')), TypeError,
+                 MESSAGES['types_do_not_match'] % ('age', str, int))
+    expect_error(lambda: construct(dict(age=3, height=1)), TypeError,
+                 MESSAGES['types_do_not_match'] % ('height', int, float))
+
+
+def test_compiled_validate_errors():
+    schema = get_schema()
+    _, validate = schema.compile(MESSAGES)
+
+    validate(dict(_id=ObjectId(), age=3))
+    expect_error(lambda: validate(dict(age=3, other=1)), AttributeError,
+                 MESSAGES['err_missing_attribute'] % 'other')
+    expect_error(lambda: validate(dict(age=3.)), TypeError,
+                 MESSAGES['err_unexpected_attribute'] % ('age', float, int))
+
+
+def test_compiled_functions_with_unusual_field_names():
+    schema = ModelSchema({"it's": FieldProperty(int, required=True), 'a"b': FieldProperty(str, if_missing='x')})
+    construct, validate = schema.compile(MESSAGES)
+
+    assert construct({"it's": 1}) == {"it's": 1, 'a"b': 'x'}, 'values do not match'
+    validate({"it's": 1, 'a"b': 'x'})
+
+
+def test_compiled_loader():
+    schema = get_schema()
+    load = schema.compile_loader()
+    _id = ObjectId()
+
+    assert load(dict(_id=_id, age='3', extra=1)) == dict(_id=_id, name='', age='3'), 'values do not match'
+    assert type(load(dict())['_id']) is ObjectId, 'default factory should be called'
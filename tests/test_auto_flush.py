@@ -0,0 +1,102 @@
+import asyncio
+
+from bson import ObjectId
+
+from mlight.attributes import FieldProperty
+from mlight.auto_flush import AutoFlusher
+from mlight.meta_model import MetaModel
+from tests.common import get_db_session, loop_runner
+
+db_session = get_db_session()
+
+
+class AutoFlushedDocument(MetaModel):
+    session = db_session
+    __model__ = 'auto_flushed_document'
+
+    _id = FieldProperty(ObjectId, if_missing=ObjectId)
+    name = FieldProperty(str, if_missing='')
+
+
+db_session.register_model(AutoFlushedDocument)
+
+
+def test_invalid_thresholds():
+    for kwargs in (dict(max_dirty=0), dict(interval=0)):
+        try:
+            AutoFlusher(db_session, **kwargs)
+            assert False, 'expected ValueError for %s' % kwargs
+        except ValueError:
+            pass
+
+
+def test_dirty_threshold_wakes_the_flusher():
+    async def wrapped():
+        auto_flusher = AutoFlusher(db_session, max_dirty=2)
+        db_session.auto_flusher = auto_flusher
+        try:
+            objects = [AutoFlushedDocument(attached=True)]
+            assert not auto_flusher._wake.is_set(), 'flusher should wait for more objects'
+            objects.append(AutoFlushedDocument(attached=True))
+            assert auto_flusher._wake.is_set(), 'flusher should be woken up'
+        finally:
+            db_session.auto_flusher = None
+            db_session.clear_all()
+
+    loop_runner(wrapped)
+
+
+def test_failures_are_reported():
+    errors = []
+
+    async def wrapped():
+        obj = AutoFlushedDocument(attached=True)
+        obj.unmapped = 1
+
+        auto_flusher = db_session.start_auto_flush(max_dirty=10, interval=0.01, on_error=errors.append)
+        assert auto_flusher.running, 'flusher should be running'
+        await asyncio.sleep(0.05)
+        await db_session.stop_auto_flush()
+
+        assert not auto_flusher.running, 'flusher should be stopped'
+        assert db_session.auto_flusher is None, 'flusher should be removed from the session'
+        assert auto_flusher.flushes == 0, 'expected no successful flush'
+        assert len(errors) == auto_flusher.errors > 0, 'errors should be reported'
+        assert type(errors[0]) is AttributeError, 'error type mismatch'
+        db_session.clear_all()
+
+    loop_runner(wrapped)
+
+
+def test_failure_is_raised_on_stop_without_callback():
+    async def wrapped():
+        obj = AutoFlushedDocument(attached=True)
+        obj.unmapped = 1
+
+        db_session.start_auto_flush(interval=10)
+        try:
+            await db_session.stop_auto_flush()
+            assert False, 'expected the flush error'
+        except AttributeError:
+            pass
+        db_session.clear_all()
+
+    loop_runner(wrapped)
+
+
+def test_flusher_started_within_a_unit_flushes_the_session():
+    errors = []
+
+    async def wrapped():
+        async with db_session.unit_of_work(flush=False):
+            db_session.start_auto_flush(interval=0.01, on_error=errors.append)
+        obj = AutoFlushedDocument(attached=True)
+        obj.unmapped = 1
+        await asyncio.sleep(0.05)
+        await db_session.stop_auto_flush()
+
+        assert len(errors) > 0, 'objects of the session should be flushed'
+        assert type(errors[0]) is AttributeError, 'error type mismatch'
+        db_session.clear_all()
+
+    loop_runner(wrapped)
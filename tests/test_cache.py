@@ -0,0 +1,57 @@
+from mlight.cache import LRUCache
+
+
+class Clock:
+    def __init__(self):
+        self.now = 0.
+
+    def __call__(self):
+        return self.now
+
+
+def test_lru_cache_hit_and_miss():
+    cache = LRUCache(max_size=2)
+
+    assert cache.get('a') is None, 'expected a miss'
+    cache.set('a', {'_id': 'a'})
+    assert cache.get('a') == {'_id': 'a'}, 'expected a hit'
+
+    assert cache.hits == 1, 'expected 1 hit'
+    assert cache.misses == 1, 'expected 1 miss'
+
+
+def test_lru_cache_evicts_least_recently_used():
+    cache = LRUCache(max_size=2)
+
+    cache.set('a', {'_id': 'a'})
+    cache.set('b', {'_id': 'b'})
+    cache.get('a')
+    cache.set('c', {'_id': 'c'})
+
+    assert cache.get('b') is None, 'b should be evicted'
+    assert cache.get('a') is not None, 'a was recently used'
+    assert cache.get('c') is not None, 'c was just added'
+    assert cache.evictions == 1, 'expected 1 eviction'
+    assert len(cache) == 2, 'expected 2 items'
+
+
+def test_lru_cache_ttl():
+    clock = Clock()
+    cache = LRUCache(max_size=2, ttl=10, timer=clock)
+
+    cache.set('a', {'_id': 'a'})
+    clock.now = 9.9
+    assert cache.get('a') is not None, 'a should not be expired'
+    clock.now = 10
+    assert cache.get('a') is None, 'a should be expired'
+    assert cache.evictions == 1, 'expired documents count as evictions'
+
+
+def test_lru_cache_delete():
+    cache = LRUCache()
+
+    cache.set('a', {'_id': 'a'})
+    cache.delete('a')
+    cache.delete('a')
+
+    assert cache.get('a') is None, 'a should be deleted'
@@ -0,0 +1,58 @@
+import datetime
+from unittest import SkipTest
+
+from mlight import columns
+from mlight.columns import ColumnBuilder, to_arrow
+
+
+def setup_module():
+    if columns.numpy is None:
+        raise SkipTest('numpy is not installed')
+
+
+def build(data_type, values, chunk_size=2):
+    builder = ColumnBuilder('field', data_type)
+    for index, value in enumerate(values):
+        builder.append(value)
+        if (index + 1) % chunk_size == 0:
+            builder.flush()
+    return builder.build()
+
+
+def test_numeric_column_with_missing_values():
+    column = build(int, [1, None, 3, 4, None])
+
+    assert str(column.dtype) == 'int64', 'unexpected dtype'
+    assert column.mask.tolist() == [False, True, False, False, True], 'unexpected mask'
+    assert column.compressed().tolist() == [1, 3, 4], 'values do not match'
+
+
+def test_typed_columns():
+    assert str(build(float, [1.5, 2.]).dtype) == 'float64', 'unexpected dtype'
+    assert str(build(bool, [True, None]).dtype) == 'bool', 'unexpected dtype'
+    dates = build(datetime.datetime, [datetime.datetime(2020, 1, 1), None, datetime.datetime(2020, 1, 2)])
+    assert str(dates.dtype) == 'datetime64[ms]', 'unexpected dtype'
+    assert dates.mask.tolist() == [False, True, False], 'unexpected mask'
+
+
+def test_object_column():
+    column = build(str, ['a', None, 'c'], chunk_size=10)
+
+    assert column.dtype == object, 'unexpected dtype'
+    assert column.compressed().tolist() == ['a', 'c'], 'values do not match'
+
+
+def test_empty_column():
+    column = ColumnBuilder('field', int).build()
+
+    assert len(column) == 0, 'expected 0 items'
+
+
+def test_arrow_table():
+    if columns.pyarrow is None:
+        raise SkipTest('pyarrow is not installed')
+
+    table = to_arrow(dict(age=build(int, [1, None]), name=build(str, ['a', None])))
+
+    assert table.column('age').to_pylist() == [1, None], 'values do not match'
+    assert table.column('name').to_pylist() == ['a', None], 'values do not match'
@@ -1,8 +1,14 @@
+import asyncio
+
 from bson import ObjectId
 from nose import with_setup
+from pymongo.errors import BulkWriteError
 
 from mlight.attributes import FieldProperty
-from mlight.meta_model import MetaModel
+from mlight.cache import LRUCache
+from mlight.meta_model import MetaModel, PENDING, PERSISTENT
+from mlight.session import DBSession
+from mlight.utils import FlushError
 from tests.common import get_db_session, drop_all_collections, loop_runner, drop_database
 
 db_session = get_db_session()
@@ -43,6 +49,34 @@ class CreatedDocumentModel(MetaModel):
 db_session.register_model(CreatedDocumentModel)
 
 
+class TaggedDocumentModel(MetaModel):
+    session = db_session
+    __model__ = 'tagged_document'
+
+    _id = FieldProperty(ObjectId, if_missing=ObjectId)
+
+    tags = FieldProperty(list, tracked=True, if_missing=list)
+
+
+db_session.register_model(TaggedDocumentModel)
+
+# same database, writes are buffered until drained
+write_behind_session = DBSession(db_session.mongo_uri, db_session.database_name, write_behind=60)
+
+
+class BufferedDocumentModel(MetaModel):
+    session = write_behind_session
+    __model__ = 'buffered_document'
+
+    _id = FieldProperty(ObjectId, if_missing=ObjectId)
+
+    name = FieldProperty(str, required=True, if_missing='')
+    counter = FieldProperty(int, if_missing=0)
+
+
+write_behind_session.register_model(BufferedDocumentModel)
+
+
 @with_setup(setup_function, teardown_function)
 def test_flush_on_object():
     async def run_async():
@@ -109,3 +143,306 @@ def test_flush_with_no_integrity_check():
         assert q_obj.age == obj.age, 'age does not match'
 
     loop_runner(run_async)
+
+
+@with_setup(setup_function, teardown_function)
+def test_flush_on_session_in_batches():
+    async def run_async():
+        objects = [CreatedDocumentModel(age=x, attached=True) for x in range(5)]
+
+        results = await db_session.flush_all(batch_size=2, ordered=False)
+
+        result = results[CreatedDocumentModel.__model__]
+        assert result.batches == 3, 'expected 3 batches'
+        assert result.inserted_count == 5, 'expected 5 inserted documents'
+        assert len(CreatedDocumentModel.to_flush) == 0, 'expected 0 items to flush'
+
+        for obj in objects:
+            q_obj = await CreatedDocumentModel.get(obj._id)
+            assert q_obj is not None, 'Expected a result, something went wrong'
+            assert q_obj.age == obj.age, 'age does not match'
+
+    loop_runner(run_async)
+
+
+@with_setup(setup_function, teardown_function)
+def test_concurrent_flush_on_session_aggregates_errors():
+    class BrokenDocumentModel1(MetaModel):
+        session = db_session
+        __model__ = 'broken_document_1'
+
+        _id = FieldProperty(ObjectId, if_missing=ObjectId)
+
+    class BrokenDocumentModel2(MetaModel):
+        session = db_session
+        __model__ = 'broken_document_2'
+
+        _id = FieldProperty(ObjectId, if_missing=ObjectId)
+
+    db_session.register_model(BrokenDocumentModel1)
+    db_session.register_model(BrokenDocumentModel2)
+
+    async def run_async():
+        obj2 = BrokenDocumentModel2(attached=True)
+        obj2.unmapped = 2
+        obj1 = BrokenDocumentModel1(attached=True)
+        obj1.unmapped = 1
+
+        try:
+            await db_session.flush_all(concurrent=True, max_concurrency=2)
+            assert False, 'test failed'
+        except FlushError as e:
+            assert list(e.errors.keys()) == ['broken_document_1', 'broken_document_2'], 'unexpected error order'
+            for error in e.errors.values():
+                assert type(error) is AttributeError, 'error type mismatch'
+            assert len(e.results) == 0, 'expected no successful collections'
+
+    loop_runner(run_async)
+
+
+@with_setup(setup_function, teardown_function)
+def test_insert_many():
+    duplicated_id = ObjectId()
+
+    def records():
+        for x in range(10):
+            yield dict(age=x, name='name %d' % x)
+        yield dict(name='missing age')
+        yield dict(age='wrong type')
+        yield dict(_id=duplicated_id, age=1)
+        yield dict(_id=duplicated_id, age=2)
+
+    async def run_async():
+        result = await CreatedDocumentModel.insert_many(records(), batch_size=3)
+
+        assert result.inserted_count == 11, 'expected 11 inserted documents'
+        assert result.batches == 5, 'expected 5 batches'
+        assert [index for index, _ in result.errors] == [10, 11, 13], 'unexpected failed records'
+        assert type(result.errors[0][1]) is AttributeError, 'error type mismatch'
+        assert type(result.errors[1][1]) is TypeError, 'error type mismatch'
+
+        count = await CreatedDocumentModel.collection.count_documents({})
+        assert count == 11, 'expected 11 documents'
+
+    loop_runner(run_async)
+
+
+@with_setup(setup_function, teardown_function)
+def test_write_behind_merges_flushes():
+    async def run_async():
+        obj = BufferedDocumentModel(name='first')
+        await obj.flush()
+        for _ in range(5):
+            obj.inc('counter')
+            await obj.flush()
+        obj.name = 'last'
+        await write_behind_session.flush_all()
+
+        count = await BufferedDocumentModel.collection.count_documents({})
+        assert count == 0, 'writes should be buffered'
+
+        results = await write_behind_session.drain()
+        assert results['buffered_document'].batches == 1, 'expected a single bulk_write'
+        assert results['buffered_document'].inserted_count == 1, 'expected a single insert'
+
+        document = await BufferedDocumentModel.collection.find_one({'_id': obj._id})
+        assert document == dict(_id=obj._id, name='last', counter=5), 'merged writes do not match'
+        assert len(await write_behind_session.drain()) == 0, 'buffer should be empty'
+
+    loop_runner(run_async)
+
+
+@with_setup(setup_function, teardown_function)
+def test_auto_flush():
+    async def run_async():
+        db_session.start_auto_flush(max_dirty=3, interval=60)
+        objects = [CreatedDocumentModel(age=x, attached=True) for x in range(3)]
+        await asyncio.sleep(0.5)
+
+        count = await CreatedDocumentModel.collection.count_documents({})
+        assert count == 3, 'objects should be flushed once max_dirty is reached'
+
+        objects.append(CreatedDocumentModel(age=4, attached=True))
+        await db_session.stop_auto_flush()
+        count = await CreatedDocumentModel.collection.count_documents({})
+        assert count == 4, 'remaining objects should be flushed on stop'
+
+    loop_runner(run_async)
+
+
+@with_setup(setup_function, teardown_function)
+def test_concurrent_units_of_work():
+    async def handler(age, fail):
+        async with db_session.unit_of_work():
+            CreatedDocumentModel(age=age, attached=True)
+            await asyncio.sleep(0.01)
+            if fail:
+                raise ValueError('handler failed')
+
+    async def run_async():
+        outside = CreatedDocumentModel(age=100, attached=True)
+        outcomes = await asyncio.gather(handler(1, False), handler(2, True), handler(3, False),
+                                        return_exceptions=True)
+        assert type(outcomes[1]) is ValueError, 'expected the handler error'
+
+        ages = sorted(document['age'] for document in await CreatedDocumentModel.collection.find().to_list(None))
+        assert ages == [1, 3], 'only the objects of the successful units should be flushed'
+        assert list(CreatedDocumentModel.to_flush) == [outside], 'objects outside units should not be flushed'
+
+    loop_runner(run_async)
+
+
+@with_setup(setup_function, teardown_function)
+def test_transactional_flush():
+    async def run_async():
+        objects = [CreatedDocumentModel(age=x, attached=True) for x in range(3)]
+        results = await db_session.flush_all(transactional=True, batch_size=2)
+
+        assert results['created_document'].inserted_count == 3, 'expected 3 inserted documents'
+        assert len(CreatedDocumentModel.to_flush) == 0, 'objects should be flushed'
+        count = await CreatedDocumentModel.collection.count_documents({})
+        assert count == 3, 'expected 3 documents'
+
+        objects[0].age = 10
+        # duplicated _id, the insert fails
+        duplicated = CreatedDocumentModel(_id=objects[1]._id, age=20, attached=True)
+        try:
+            await db_session.flush_all(transactional=True)
+            assert False, 'expected the duplicated key error'
+        except BulkWriteError:
+            pass
+
+        document = await CreatedDocumentModel.collection.find_one({'_id': objects[0]._id})
+        if await db_session.supports_transactions():
+            assert document['age'] == 0, 'the transaction should be rolled back'
+            assert objects[0] in CreatedDocumentModel.to_flush, 'objects should stay dirty'
+        else:
+            # standalone servers fall back to plain bulk writes
+            assert document['age'] == 10, 'the update should be written'
+        assert duplicated in CreatedDocumentModel.to_flush, 'failed objects should stay dirty'
+
+    loop_runner(run_async)
+
+
+@with_setup(setup_function, teardown_function)
+def test_changes_made_during_flush_are_kept():
+    async def run_async():
+        obj = CreatedDocumentModel(age=0, attached=True)
+        flushing = asyncio.ensure_future(db_session.flush_all())
+        # the insert is built, the object is changed while it is written
+        await asyncio.sleep(0)
+        obj.inc('age')
+        await flushing
+
+        assert obj in CreatedDocumentModel.to_flush, 'the object should still be flushed'
+        await db_session.flush_all()
+        document = await CreatedDocumentModel.collection.find_one({'_id': obj._id})
+        assert document['age'] == 1, 'the change should be written'
+
+    loop_runner(run_async)
+
+
+@with_setup(setup_function, teardown_function)
+def test_values_changed_during_flush_are_sent_once():
+    async def run_async():
+        obj = TaggedDocumentModel(attached=True)
+        await db_session.flush_all()
+
+        obj.tags = ['a', 'b']
+        flushing = asyncio.ensure_future(db_session.flush_all())
+        # the $set is built, the list is changed while it is encoded and written
+        await asyncio.sleep(0)
+        obj.tags.append('c')
+        await flushing
+        await db_session.flush_all()
+
+        document = await TaggedDocumentModel.collection.find_one({'_id': obj._id})
+        assert document['tags'] == ['a', 'b', 'c'], 'the appended value should be written once'
+
+    loop_runner(run_async)
+
+
+@with_setup(setup_function, teardown_function)
+def test_partially_failed_flush_does_not_repeat_operators():
+    async def run_async():
+        obj = CreatedDocumentModel(age=0)
+        await obj.flush()
+
+        obj.inc('age')
+        # duplicated _id, the insert fails after the $inc succeeded
+        duplicated = CreatedDocumentModel(_id=obj._id, age=1, attached=True)
+        for _ in range(2):
+            try:
+                await CreatedDocumentModel.bulk_flush([obj, duplicated])
+                assert False, 'expected the duplicated key error'
+            except BulkWriteError:
+                pass
+            assert obj not in CreatedDocumentModel.to_flush, 'the $inc should be marked as flushed'
+            assert duplicated in CreatedDocumentModel.to_flush, 'failed objects should stay dirty'
+
+        document = await CreatedDocumentModel.collection.find_one({'_id': obj._id})
+        assert document['age'] == 1, 'the $inc should be applied once'
+
+    loop_runner(run_async)
+
+
+@with_setup(setup_function, teardown_function)
+def test_partially_failed_flush_marks_inserted_objects():
+    async def run_async():
+        existing = CreatedDocumentModel(age=0)
+        await existing.flush()
+
+        first = CreatedDocumentModel(age=1, attached=True)
+        duplicated = CreatedDocumentModel(_id=existing._id, age=2, attached=True)
+        last = CreatedDocumentModel(age=3, attached=True)
+        try:
+            await CreatedDocumentModel.bulk_flush([first, duplicated, last], ordered=False)
+            assert False, 'expected the duplicated key error'
+        except BulkWriteError as e:
+            assert len(e.details['writeErrors']) == 1, 'only the duplicated insert should fail'
+
+        assert first.state == last.state == PERSISTENT, 'inserted objects should be flushed'
+        assert duplicated.state == PENDING, 'the failed insert should stay pending'
+        assert [obj.flush_operation() for obj in (first, last)] == [None, None], 'nothing left to insert'
+
+        count = await CreatedDocumentModel.collection.count_documents({})
+        assert count == 3, 'expected 3 documents'
+
+    loop_runner(run_async)
+
+
+@with_setup(setup_function, teardown_function)
+def test_write_behind_cache_and_failures():
+    async def run_async():
+        BufferedDocumentModel.cache = LRUCache()
+        try:
+            obj = BufferedDocumentModel(name='first')
+            await obj.flush()
+            await write_behind_session.drain()
+
+            obj.name = 'second'
+            await obj.flush()
+            # read during the window, the old document is cached
+            assert (await BufferedDocumentModel.get(obj._id)).name == 'first', 'expected the stored document'
+            await write_behind_session.drain()
+            assert BufferedDocumentModel.cache.get(obj._id) is None, 'cache should be invalidated once written'
+            assert (await BufferedDocumentModel.get(obj._id)).name == 'second', 'expected the written document'
+        finally:
+            BufferedDocumentModel.cache = None
+
+        duplicated = BufferedDocumentModel(_id=obj._id, name='duplicated')
+        other = BufferedDocumentModel(name='other')
+        await duplicated.flush()
+        await other.flush()
+        try:
+            await write_behind_session.drain()
+            assert False, 'expected the duplicated key error'
+        except BulkWriteError:
+            pass
+
+        assert len(write_behind_session.write_buffer) == 1, 'operations not written should be kept'
+        await write_behind_session.drain()
+        count = await BufferedDocumentModel.collection.count_documents({})
+        assert count == 2, 'the other document should be written'
+
+    loop_runner(run_async)
@@ -0,0 +1,64 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+from bson import BSON, ObjectId
+
+from mlight.attributes import FieldProperty
+from mlight.hydration import load_batch, map_batch
+from mlight.meta_model import MetaModel
+from mlight.tracking import TrackedList
+from tests.common import get_db_session, loop_runner
+
+db_session = get_db_session(identity_map=True)
+
+
+class HydratedDocument(MetaModel):
+    session = db_session
+    __model__ = 'hydrated_document'
+
+    _id = FieldProperty(ObjectId, if_missing=ObjectId)
+    name = FieldProperty(str, if_missing='')
+    age = FieldProperty(int)
+    tags = FieldProperty(list, tracked=True, if_missing=list)
+
+
+db_session.register_model(HydratedDocument)
+
+
+def make_batch(documents):
+    return b''.join(BSON.encode(document) for document in documents)
+
+
+def test_load_batch():
+    documents = [dict(_id=ObjectId(), name='name %d' % x, age=x) for x in range(3)]
+    batch = load_batch(HydratedDocument, make_batch(documents))
+
+    assert [values for values, _ in batch] == [dict(document, tags=[]) for document in documents], \
+        'values do not match'
+    assert all(changed == {'tags'} for _, changed in batch), 'defaults should be tracked as changed'
+
+    batch = load_batch(HydratedDocument, make_batch(documents), loaded={'_id', 'age'})
+    assert batch[0][0] == dict(_id=documents[0]['_id'], age=0), 'only the loaded fields are expected'
+
+
+def test_map_batch_in_executor():
+    documents = [dict(_id=ObjectId(), name='name %d' % x, age=x) for x in range(3)]
+
+    async def wrapped():
+        loop = asyncio.get_event_loop()
+        with ThreadPoolExecutor(1) as executor:
+            batch = await loop.run_in_executor(executor, load_batch, HydratedDocument, make_batch(documents))
+        objects = map_batch(HydratedDocument, batch, attached=True)
+
+        assert [obj.age for obj in objects] == [0, 1, 2], 'values do not match'
+        assert type(objects[0].tags) is TrackedList, 'tracked values should be wrapped on the loop'
+        assert objects[0].__dict__.changed == {'tags'}, 'defaults should be tracked as changed'
+        assert objects[0] in HydratedDocument.to_flush, 'objects should be attached'
+        assert db_session.lookup(HydratedDocument, documents[1]['_id']) is objects[1], \
+            'objects should be added to the identity map'
+
+        again = map_batch(HydratedDocument, batch)
+        assert again[0] is objects[0], 'identity map instances should be returned'
+        db_session.clear_all()
+
+    loop_runner(wrapped)
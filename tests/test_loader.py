@@ -0,0 +1,33 @@
+import asyncio
+
+from bson import ObjectId
+
+from mlight.attributes import FieldProperty
+from mlight.loader import BatchLoader
+from mlight.meta_model import MetaModel
+from tests.common import get_db_session, loop_runner
+
+db_session = get_db_session()
+
+
+class LoadedDocument(MetaModel):
+    session = db_session
+    __model__ = 'loaded_document'
+
+    _id = FieldProperty(ObjectId, if_missing=ObjectId)
+
+
+def test_cancelled_callers_do_not_affect_the_others():
+    async def wrapped():
+        loader = BatchLoader(LoadedDocument, window=60)
+        _id = ObjectId()
+        first = loader.load(_id)
+        second = loader.load(_id)
+        assert first is not second, 'each caller should have its own future'
+        assert len(loader._pending) == 1, 'the _id should be queried once'
+
+        first.cancel()
+        assert not second.cancelled(), 'other callers should keep waiting'
+        loader._handle.cancel()
+
+    loop_runner(wrapped)
@@ -1,8 +1,10 @@
-from bson import ObjectId
+from bson import BSON, ObjectId
+from bson.raw_bson import RawBSONDocument
 from nose import with_setup
+from pymongo import InsertOne, UpdateOne
 
 from mlight.attributes import FieldProperty
-from mlight.meta_model import MetaModel
+from mlight.meta_model import MetaModel, TRANSIENT, PENDING, PERSISTENT, DETACHED
 from tests.common import get_db_session, drop_all_collections, drop_database
 
 db_session = None
@@ -12,7 +14,7 @@ MODEL_NAME = 'share'
 
 def setup_module():
     global db_session
-    db_session = get_db_session()
+    db_session = get_db_session(identity_map=True)
     print("Module '%s' setup" % __name__)
 
 
@@ -364,3 +366,229 @@ def test_successful_creation_object_ignoring_extra_fields():
     assert 'other_field' not in obj.__dict__, 'unexpected field'
     assert 'name' in obj.__dict__, 'name field is not mandatory'
     assert len(obj.__dict__) == 2, 'expected only 2 field'
+
+
+@with_setup(setup_function, teardown_function)
+def test_flush_update_tracks_changed_fields():
+    class ShareModel19(MetaModel):
+        __model__ = MODEL_NAME
+        session = db_session
+
+        _id = FieldProperty(ObjectId, if_missing=ObjectId)
+
+        name = FieldProperty(str, required=True)
+        age = FieldProperty(int)
+
+    db_session.register_model(ShareModel19)
+
+    obj = ShareModel19(name='name', age=3)
+    assert obj.flush_update() == {'$set': {'_id': obj._id, 'name': 'name', 'age': 3}}, 'new objects send all fields'
+
+    obj.__dict__.mark_clean()
+    assert obj.flush_update() is None, 'nothing changed'
+
+    obj.name = 'other'
+    assert obj.flush_update() == {'$set': {'name': 'other'}}, 'expected only the changed field'
+
+    del obj.age
+    assert obj.flush_update() == {'$set': {'name': 'other'}, '$unset': {'age': ''}}, 'expected unset of age'
+
+    obj.age = 5
+    assert obj.flush_update() == {'$set': {'name': 'other', 'age': 5}}, 'age set again after delete'
+
+
+@with_setup(setup_function, teardown_function)
+def test_from_db_is_clean():
+    class ShareModel20(MetaModel):
+        __model__ = MODEL_NAME
+        session = db_session
+
+        _id = FieldProperty(ObjectId, if_missing=ObjectId)
+
+        name = FieldProperty(str, if_missing='default')
+        age = FieldProperty(int)
+
+    db_session.register_model(ShareModel20)
+
+    _id = ObjectId()
+    obj = ShareModel20.from_db({'_id': _id, 'age': 3})
+
+    assert obj.flush_update() == {'$set': {'name': 'default'}}, 'only defaults should be sent'
+
+
+@with_setup(setup_function, teardown_function)
+def test_successful_creation_object_with_inherited_field_properties():
+    class BaseShareModel(MetaModel):
+        __model__ = MODEL_NAME
+        session = db_session
+
+        _id = FieldProperty(ObjectId, if_missing=ObjectId)
+
+        name = FieldProperty(str, required=True)
+
+    class ShareModel21(BaseShareModel):
+        name = FieldProperty(str, if_missing='overridden')
+        age = FieldProperty(int, required=True)
+
+    db_session.register_model(ShareModel21)
+
+    obj = ShareModel21(age=3)
+
+    assert list(ShareModel21.field_properties.keys()) == ['_id', 'name', 'age'], 'unexpected fields'
+    assert type(obj._id) is ObjectId, '_id should be inherited'
+    assert obj.name == 'overridden', 'name should be overridden'
+    assert obj.age == 3, 'values do not match'
+
+
+@with_setup(setup_function, teardown_function)
+def test_from_db_validation():
+    class ShareModel22(MetaModel):
+        __model__ = MODEL_NAME
+        session = db_session
+
+        _id = FieldProperty(ObjectId, if_missing=ObjectId)
+
+        name = FieldProperty(str, required=True)
+
+    db_session.register_model(ShareModel22)
+
+    document = {'_id': ObjectId(), 'name': 3, 'other_field': 'not_present'}
+
+    obj = ShareModel22.from_db(document)
+    assert obj.name == 3, 'trusted documents are not validated'
+    assert 'other_field' not in obj.__dict__, 'unexpected field'
+
+    try:
+        ShareModel22.from_db(dict(document, _id=ObjectId()), validate=True)
+        assert False, 'test failed'
+    except TypeError as e:
+        assert str(e) == ShareModel22.__messages__['types_do_not_match'] % ('name', int, str)
+
+    ShareModel22.load_validation_rate = 1.0
+    try:
+        ShareModel22.from_db(dict(document, _id=ObjectId()))
+        assert False, 'test failed'
+    except TypeError as e:
+        assert str(e) == ShareModel22.__messages__['types_do_not_match'] % ('name', int, str)
+
+
+@with_setup(setup_function, teardown_function)
+def test_from_db_partially_loaded():
+    class ShareModel23(MetaModel):
+        __model__ = MODEL_NAME
+        session = db_session
+
+        _id = FieldProperty(ObjectId, if_missing=ObjectId)
+
+        name = FieldProperty(str, required=True)
+        age = FieldProperty(int, if_missing=0)
+        height = FieldProperty(float)
+
+    db_session.register_model(ShareModel23)
+
+    _id = ObjectId()
+    obj = ShareModel23.from_db({'_id': _id, 'name': 'name'}, fields=['name'])
+
+    assert obj.is_loaded(['name']), 'name should be loaded'
+    assert not obj.is_loaded(), 'document should be partially loaded'
+    assert obj.flush_update() is None, 'defaults of fields not loaded should not be set'
+    try:
+        obj.age
+        assert False, 'test failed'
+    except AttributeError as e:
+        assert str(e) == ShareModel23.__messages__['field_not_loaded'] % 'age'
+
+    obj.height = 1.5
+    try:
+        obj.flush_update()
+        assert False, 'test failed'
+    except AttributeError as e:
+        assert str(e) == ShareModel23.__messages__['flush_not_loaded'] % 'height'
+
+    obj.merge_document({'_id': _id, 'name': 'other', 'height': 2.5})
+
+    assert obj.is_loaded(), 'document should be complete'
+    assert obj.name == 'name', 'loaded fields should be kept'
+    assert obj.age == 0, 'missing fields should be set to their defaults'
+    assert obj.height == 1.5, 'assigned fields should be kept'
+    assert obj.flush_update() == {'$set': {'age': 0, 'height': 1.5}}, 'assigned fields should be flushed'
+    assert ShareModel23.from_db({'_id': _id}) is obj, 'identity map should return the same instance'
+
+
+def test_identity_map_is_opt_in():
+    default_session = get_db_session()
+
+    class ShareModel23b(MetaModel):
+        __model__ = MODEL_NAME
+        session = default_session
+
+        _id = FieldProperty(ObjectId, if_missing=ObjectId)
+
+    _id = ObjectId()
+
+    assert default_session.identity_map is None, 'identity map should be disabled by default'
+    assert ShareModel23b.from_db({'_id': _id}) is not ShareModel23b.from_db({'_id': _id}), \
+        'each load should return a new instance'
+
+
+@with_setup(setup_function, teardown_function)
+def test_from_db_raw_document():
+    class ShareModel24(MetaModel):
+        __model__ = MODEL_NAME
+        session = db_session
+
+        _id = FieldProperty(ObjectId, if_missing=ObjectId)
+
+        name = FieldProperty(str, required=True)
+        tags = FieldProperty(list)
+        age = FieldProperty(int, if_missing=0)
+
+    db_session.register_model(ShareModel24)
+
+    _id = ObjectId()
+    document = RawBSONDocument(BSON.encode({'_id': _id, 'name': 'name', 'tags': ['a', 'b']}))
+    obj = ShareModel24.from_db(document)
+
+    assert dict(obj.__dict__) == {'_id': _id, 'age': 0}, 'fields should not be decoded yet'
+    assert obj.flush_update() == {'$set': {'age': 0}}, 'only defaults should be sent'
+    assert obj.name == 'name', 'values do not match'
+    assert obj.tags == ['a', 'b'], 'values do not match'
+    assert obj.__dict__['tags'] is obj.tags, 'decoded values should be cached'
+    assert obj.flush_update() == {'$set': {'age': 0}}, 'decoded fields are not changes'
+
+    del obj.name
+    assert obj.flush_update() == {'$set': {'age': 0}, '$unset': {'name': ''}}, 'expected unset of name'
+    assert obj.name is ShareModel24.name, 'deleted fields should not be decoded again'
+
+    obj.flushed()
+    assert 'name' not in obj.__dict__ and obj.name is ShareModel24.name, 'deleted fields should stay deleted'
+
+
+@with_setup(setup_function, teardown_function)
+def test_object_lifecycle_states():
+    class ShareModel25(MetaModel):
+        __model__ = MODEL_NAME
+        session = db_session
+
+        _id = FieldProperty(ObjectId, if_missing=ObjectId)
+
+        name = FieldProperty(str)
+
+    db_session.register_model(ShareModel25)
+
+    obj = ShareModel25(name='name')
+    assert obj.state == TRANSIENT, 'new objects are transient'
+    assert type(obj.flush_operation()) is InsertOne, 'new objects should be inserted'
+
+    obj.attach()
+    assert obj.state == PENDING, 'attached new objects are pending'
+
+    loaded_obj = ShareModel25.from_db({'_id': ObjectId(), 'name': 'name'})
+    assert loaded_obj.state == PERSISTENT, 'loaded objects are persistent'
+    assert loaded_obj.flush_operation() is None, 'clean objects should be skipped'
+
+    loaded_obj.name = 'other'
+    assert type(loaded_obj.flush_operation()) is UpdateOne, 'persistent objects should be updated'
+
+    db_session.forget(loaded_obj)
+    assert loaded_obj.state == DETACHED, 'forgotten objects are detached'
@@ -0,0 +1,34 @@
+from mlight.prefetch import BatchSizer
+
+
+def test_batch_sizer_defaults_to_the_server():
+    sizer = BatchSizer()
+    assert sizer.batch_size is None, 'expected the server default before any batch'
+
+    sizer.observe(0, 0, 0)
+    assert sizer.batch_size is None, 'empty batches should be ignored'
+
+
+def test_batch_sizer_limits():
+    sizer = BatchSizer(target_bytes=1000, target_seconds=1, min_size=2, max_size=50)
+
+    sizer.observe(10, 1000, 0)
+    assert sizer.batch_size == 10, 'batches should fit in target_bytes'
+
+    sizer = BatchSizer(target_bytes=1000, target_seconds=1, min_size=2, max_size=50)
+    sizer.observe(10, 10, 0)
+    assert sizer.batch_size == 50, 'batch size should not exceed max_size'
+
+    sizer = BatchSizer(target_bytes=1000, target_seconds=0.1, min_size=2, max_size=50)
+    sizer.observe(10, 10, 1)
+    assert sizer.batch_size == 2, 'slow hydration should shrink the batches down to min_size'
+
+
+def test_batch_sizer_adapts():
+    sizer = BatchSizer(target_bytes=10000, target_seconds=1, min_size=1, max_size=10000, smoothing=0.5)
+    sizer.observe(10, 1000, 0.1)
+    assert sizer.batch_size == 100, 'expected target_bytes / document size'
+
+    sizer.observe(10, 3000, 0.1)
+    assert sizer.document_size == 200, 'document size should be averaged'
+    assert sizer.batch_size == 50, 'bigger documents should shrink the batches'
@@ -1,11 +1,17 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from unittest import SkipTest
+
 from bson import ObjectId
 from nose import with_setup
 
+from mlight import columns
 from mlight.attributes import FieldProperty
+from mlight.cache import LRUCache
 from mlight.meta_model import MetaModel
 from tests.common import get_db_session, drop_all_collections, loop_runner, drop_database
 
-db_session = get_db_session()
+db_session = get_db_session(identity_map=True)
 
 
 def setup_module():
@@ -119,3 +125,313 @@ def test_query_collection_find():
     loop_runner(run_async)
 
     # query a document update it and save it in the session!
+
+
+@with_setup(setup_function, teardown_function)
+def test_query_update_changed_field():
+    obj = QueryDocument(name='before', age=10, height=1.5)
+
+    async def run_async():
+        await obj.flush()
+
+        query_obj = await QueryDocument.get(obj._id, attached=True)
+        assert query_obj.flush_update() is None, 'loaded object should be clean'
+
+        query_obj.name = 'after'
+        assert query_obj.flush_update() == {'$set': {'name': 'after'}}, 'expected only the changed field'
+        await QueryDocument.flush_all()
+
+        updated_obj = await QueryDocument.get(obj._id)
+        assert updated_obj.name == 'after', 'name field should be updated'
+        assert updated_obj.age == obj.age, 'age field should match'
+        assert updated_obj.height == obj.height, 'height field should match'
+
+    loop_runner(run_async)
+
+
+@with_setup(setup_function, teardown_function)
+def test_query_iter():
+    objects = {obj._id: obj for obj in (QueryDocument(age=x) for x in range(5))}
+
+    async def run_async():
+        for obj in objects.values():
+            await obj.flush()
+
+        found = 0
+        async for query_obj in QueryDocument.iter({'age': {'$gte': 0}}, batch_size=2):
+            assert query_obj.age == objects[query_obj._id].age, 'age field should match'
+            found += 1
+        assert found == len(objects), 'expected all objects'
+
+        documents = QueryDocument.iter(batch_size=2)
+        async for _ in documents:
+            break
+        await documents.aclose()
+
+    loop_runner(run_async)
+
+
+@with_setup(setup_function, teardown_function)
+def test_query_identity_map():
+    obj = QueryDocument(age=42)
+
+    async def run_async():
+        await obj.flush()
+        assert (await QueryDocument.get(obj._id)) is obj, 'flushed object should be returned'
+
+        db_session.clear_identity_map()
+        query_obj = await QueryDocument.get(obj._id)
+        assert query_obj is not obj, 'expected a new instance'
+        assert (await QueryDocument.get(obj._id)) is query_obj, 'expected the same instance'
+
+        query_obj.name = 'not flushed'
+        results = await QueryDocument.find({'_id': obj._id})
+        assert results[0] is query_obj, 'find should reuse the loaded instance'
+        assert results[0].name == 'not flushed', 'local changes should be kept'
+
+    loop_runner(run_async)
+
+
+@with_setup(setup_function, teardown_function)
+def test_query_get_with_cache():
+    class CachedDocument(MetaModel):
+        session = db_session
+        __model__ = 'cached_document'
+        cache = LRUCache(max_size=10)
+
+        _id = FieldProperty(ObjectId, if_missing=ObjectId)
+        age = FieldProperty(int, required=True)
+
+    db_session.register_model(CachedDocument)
+
+    async def run_async():
+        obj = CachedDocument(age=1)
+        await obj.flush()
+        db_session.clear_identity_map()
+
+        await CachedDocument.get(obj._id)
+        db_session.clear_identity_map()
+        query_obj = await CachedDocument.get(obj._id)
+        assert CachedDocument.cache.misses == 1, 'expected 1 miss'
+        assert CachedDocument.cache.hits == 1, 'expected 1 hit'
+        assert query_obj.age == 1, 'age field should match'
+
+        query_obj.age = 2
+        await query_obj.flush()
+        assert len(CachedDocument.cache) == 0, 'flushed documents should be invalidated'
+
+    loop_runner(run_async)
+
+
+@with_setup(setup_function, teardown_function)
+def test_query_batched_get():
+    objects = [QueryDocument(age=x) for x in range(5)]
+
+    async def run_async():
+        for obj in objects:
+            await obj.flush()
+        db_session.clear_identity_map()
+
+        missing_id = ObjectId()
+        results = await asyncio.gather(*[QueryDocument.get(obj._id, batched=True) for obj in objects],
+                                       QueryDocument.get(missing_id, batched=True))
+
+        assert results[-1] is None, 'missing document should be None'
+        for obj, query_obj in zip(objects, results):
+            assert obj._id == query_obj._id, '_id field should match'
+            assert obj.age == query_obj.age, 'age field should match'
+
+    loop_runner(run_async)
+
+
+@with_setup(setup_function, teardown_function)
+def test_query_batched_get_callers_are_independent():
+    obj = QueryDocument(age=1)
+
+    async def run_async():
+        await obj.flush()
+        db_session.clear_identity_map()
+
+        loader = db_session.loader(QueryDocument)
+        cancelled = asyncio.ensure_future(QueryDocument.get(obj._id, batched=True))
+        documents = asyncio.gather(loader.load(obj._id), loader.load(obj._id))
+        await asyncio.sleep(0)
+        cancelled.cancel()
+        first, second = await documents
+
+        assert cancelled.cancelled(), 'the caller should be cancelled'
+        assert first == second, 'documents should match'
+        assert first is not second, 'each caller should get its own copy'
+
+    loop_runner(run_async)
+
+
+@with_setup(setup_function, teardown_function)
+def test_query_get_many():
+    objects = [QueryDocument(age=x) for x in range(7)]
+
+    async def run_async():
+        for obj in objects:
+            await obj.flush()
+        db_session.clear_identity_map()
+        loaded = await QueryDocument.get(objects[3]._id)
+
+        missing_id = ObjectId()
+        ids = [obj._id for obj in reversed(objects)] + [missing_id, objects[0]._id]
+        results, missing = await QueryDocument.get_many(ids, chunk_size=2)
+
+        assert missing == [missing_id], 'expected one missing id'
+        assert results[-2] is None, 'missing document should be None'
+        assert results[3] is loaded, 'loaded instance should be reused'
+        assert results[-1] is results[-3], 'repeated ids should map to the same instance'
+        for obj, query_obj in zip(reversed(objects), results):
+            assert obj._id == query_obj._id, 'input order should be preserved'
+            assert obj.age == query_obj.age, 'age field should match'
+
+    loop_runner(run_async)
+
+
+def test_get_many_invalid_concurrency():
+    async def run_async():
+        try:
+            await QueryDocument.get_many([ObjectId()], max_concurrency=0)
+            assert False, 'expected ValueError'
+        except ValueError:
+            pass
+
+    loop_runner(run_async)
+
+
+@with_setup(setup_function, teardown_function)
+def test_query_find_with_fields():
+    objects = [QueryDocument(name='name %d' % x, age=x, height=float(x)) for x in range(3)]
+
+    async def run_async():
+        for obj in objects:
+            await obj.flush()
+        db_session.clear_identity_map()
+
+        results = await QueryDocument.find({}, fields=['age'])
+        for query_obj in results:
+            assert query_obj.is_loaded(['age']), 'age should be loaded'
+            assert 'name' not in query_obj.__dict__, 'name should not be loaded'
+
+        await QueryDocument.load_fields(results, fields=['name'])
+        for query_obj in results:
+            assert query_obj.name == 'name %d' % query_obj.age, 'name field should match'
+
+        await results[0].load()
+        assert results[0].is_loaded(), 'document should be complete'
+        assert results[0].height == float(results[0].age), 'height field should match'
+
+    loop_runner(run_async)
+
+
+@with_setup(setup_function, teardown_function)
+def test_query_raw_documents():
+    class RawDocument(MetaModel):
+        session = db_session
+        __model__ = 'raw_document'
+        raw_documents = True
+
+        _id = FieldProperty(ObjectId, if_missing=ObjectId)
+        name = FieldProperty(str, required=True)
+        age = FieldProperty(int, required=True)
+
+    db_session.register_model(RawDocument)
+
+    async def run_async():
+        obj = RawDocument(name='name', age=3)
+        await obj.flush()
+        db_session.clear_identity_map()
+
+        results = await RawDocument.find({'_id': obj._id})
+        assert 'name' not in results[0].__dict__, 'name should not be decoded yet'
+        assert results[0].name == obj.name, 'name field should match'
+        assert results[0].age == obj.age, 'age field should match'
+
+    loop_runner(run_async)
+
+
+@with_setup(setup_function, teardown_function)
+def test_query_find_columns():
+    if columns.numpy is None:
+        raise SkipTest('numpy is not installed')
+
+    objects = [QueryDocument(age=x, height=float(x)) if x % 2 else QueryDocument(age=x) for x in range(4)]
+
+    async def run_async():
+        for obj in objects:
+            await obj.flush()
+
+        result = await QueryDocument.find_columns({}, fields=['age', 'height'], batch_size=3)
+
+        assert sorted(result['age'].tolist()) == [0, 1, 2, 3], 'age values do not match'
+        assert int(result['height'].count()) == 2, 'expected 2 heights'
+
+    loop_runner(run_async)
+
+
+@with_setup(setup_function, teardown_function)
+def test_query_offloaded_hydration():
+    async def run_async():
+        await QueryDocument.insert_many(dict(age=x, name='name %d' % x) for x in range(25))
+        db_session.clear_identity_map()
+
+        with ThreadPoolExecutor(2) as executor:
+            ages = [obj.age async for obj in QueryDocument.iter({'age': {'$gte': 5}}, batch_size=4, offload=True,
+                                                                executor=executor, max_in_flight=2)]
+        assert sorted(ages) == list(range(5, 25)), 'expected the matching objects'
+
+        objects = await QueryDocument.find({'age': {'$lt': 5}}, fields=['age'], offload=True)
+        assert sorted(obj.age for obj in objects) == list(range(5)), 'expected the matching objects'
+        assert not objects[0].is_loaded(['name']), 'name should not be loaded'
+
+    loop_runner(run_async)
+
+
+@with_setup(setup_function, teardown_function)
+def test_query_prefetch():
+    async def run_async():
+        await QueryDocument.insert_many(dict(age=x, name='name %d' % x) for x in range(25))
+
+        ages = [obj.age async for obj in QueryDocument.iter({'age': {'$gte': 5}}, batch_size=4, prefetch=True)]
+        assert sorted(ages) == list(range(5, 25)), 'expected the matching objects'
+        sizer = db_session.batch_sizer(QueryDocument)
+        assert sizer.document_size > 0, 'document size should be observed'
+        assert sizer.batch_size is not None, 'following queries should use the adaptive batch size'
+
+        objects = await QueryDocument.find({'age': {'$lt': 5}}, fields=['age'], prefetch=True)
+        assert sorted(obj.age for obj in objects) == list(range(5)), 'expected the matching objects'
+
+        cursor = QueryDocument.prefetch_cursor(batch_size=2).iter()
+        async for _ in cursor:
+            break
+        await cursor.aclose()
+
+    loop_runner(run_async)
+
+
+@with_setup(setup_function, teardown_function)
+def test_query_builder():
+    adults = QueryDocument.query(age={'$gte': 18}).sort('-age').max_time_ms(1000)
+
+    async def run_async():
+        await QueryDocument.insert_many(dict(age=x, name='name %d' % x) for x in range(30))
+
+        assert await adults.count() == 12, 'expected 12 adults'
+        assert await adults.limit(5).count() == 5, 'count should apply the limit'
+        assert await adults.exists(), 'adults should exist'
+        assert not await adults.filter(name='nobody').exists(), 'nobody should not exist'
+
+        oldest = await adults.first()
+        assert oldest.age == 29, 'expected the oldest document'
+
+        page = await adults.skip(2).limit(3).fields('age').all()
+        assert [obj.age for obj in page] == [27, 26, 25], 'expected the third page'
+        assert not page[0].is_loaded(['name']), 'name should not be loaded'
+
+        ages = [obj.age async for obj in adults.batch_size(4).iter(prefetch=True)]
+        assert ages == list(range(29, 17, -1)), 'expected the sorted adults'
+
+    loop_runner(run_async)
@@ -0,0 +1,70 @@
+from bson import ObjectId
+from pymongo import ASCENDING, DESCENDING
+
+from mlight.attributes import FieldProperty
+from mlight.meta_model import MetaModel
+from tests.common import get_db_session
+
+db_session = get_db_session()
+
+
+class QueriedDocument(MetaModel):
+    session = db_session
+    __model__ = 'queried_document'
+
+    _id = FieldProperty(ObjectId, if_missing=ObjectId)
+    name = FieldProperty(str, if_missing='')
+    age = FieldProperty(int)
+    attributes = FieldProperty(dict, if_missing=dict)
+
+
+def expect_unknown_field(build):
+    try:
+        build()
+        assert False, 'expected AttributeError'
+    except AttributeError as e:
+        assert 'missing' in str(e), 'error should name the field'
+
+
+def test_compile():
+    query = QueriedDocument.query(age={'$gte': 18}).sort('-age', ('name', ASCENDING)).skip(5).limit(10) \
+        .hint([('age', DESCENDING)]).max_time_ms(500).batch_size(100)
+
+    assert query.compile() == ({'age': {'$gte': 18}}, dict(sort=[('age', DESCENDING), ('name', ASCENDING)], skip=5,
+                                                           limit=10, hint=[('age', DESCENDING)], max_time_ms=500)), \
+        'compiled query does not match'
+    assert query.compile() is query.compile(), 'compiled query should be cached'
+    assert QueriedDocument.query().compile() == (dict(), dict()), 'expected an empty query'
+
+
+def test_queries_are_immutable():
+    base = QueriedDocument.query(name='a')
+    limited = base.limit(3)
+    filtered = base.filter({'age': 1})
+
+    assert base.compile() == ({'name': 'a'}, dict()), 'base query should not change'
+    assert limited.compile() == ({'name': 'a'}, dict(limit=3)), 'limit should be set'
+    assert filtered.compile() == ({'name': 'a', 'age': 1}, dict()), 'filters should be combined'
+    assert base.filter(name='b').compile()[0] == {'$and': [{'name': 'a'}, {'name': 'b'}]}, \
+        'conditions on the same field should be kept'
+
+
+def test_fields_are_validated():
+    expect_unknown_field(lambda: QueriedDocument.query(missing=1))
+    expect_unknown_field(lambda: QueriedDocument.query({'$or': [{'age': 1}, {'missing.x': 1}]}))
+    expect_unknown_field(lambda: QueriedDocument.query().sort('-missing'))
+    expect_unknown_field(lambda: QueriedDocument.query().hint([('missing', ASCENDING)]))
+    expect_unknown_field(lambda: QueriedDocument.query().fields('missing'))
+
+    query = QueriedDocument.query({'attributes.color': 'red', '$comment': 'embedded fields are allowed'})
+    assert query.compile()[0]['attributes.color'] == 'red', 'embedded fields should be accepted'
+
+
+def test_invalid_options():
+    for build in (lambda: QueriedDocument.query().limit(-1), lambda: QueriedDocument.query().skip(-1),
+                  lambda: QueriedDocument.query().batch_size(0)):
+        try:
+            build()
+            assert False, 'expected ValueError'
+        except ValueError:
+            pass
@@ -0,0 +1,209 @@
+from bson import ObjectId
+from pymongo import InsertOne, UpdateOne
+
+from mlight.attributes import FieldProperty
+from mlight.meta_model import MetaModel
+from mlight.tracking import TrackedDict, TrackedList
+from tests.common import get_db_session
+
+db_session = get_db_session()
+
+
+class TrackedDocument(MetaModel):
+    session = db_session
+    __model__ = 'tracked_document'
+
+    _id = FieldProperty(ObjectId, if_missing=ObjectId)
+    counter = FieldProperty(int, if_missing=0)
+    tags = FieldProperty(list, tracked=True, if_missing=list)
+    attributes = FieldProperty(dict, tracked=True, if_missing=dict)
+    plain = FieldProperty(list, if_missing=list)
+
+
+db_session.register_model(TrackedDocument)
+
+
+class TwoListsDocument(MetaModel):
+    session = db_session
+    __model__ = 'two_lists_document'
+
+    _id = FieldProperty(ObjectId, if_missing=ObjectId)
+    first = FieldProperty(list, tracked=True, if_missing=list)
+    second = FieldProperty(list, tracked=True, if_missing=list)
+
+
+db_session.register_model(TwoListsDocument)
+
+
+def get_loaded_document():
+    return TrackedDocument.from_db(dict(_id=ObjectId(), counter=1, tags=['a'], attributes={'a': 1}, plain=[]))
+
+
+def test_tracked_values_are_wrapped():
+    obj = TrackedDocument(tags=['a'])
+
+    assert type(obj.tags) is TrackedList, 'tags should be tracked'
+    assert type(obj.attributes) is TrackedDict, 'attributes should be tracked'
+    assert type(obj.plain) is list, 'plain should not be tracked'
+    obj.check_integrity()
+
+    obj.tags = ['b']
+    assert type(obj.tags) is TrackedList, 'assigned values should be tracked'
+    assert type(get_loaded_document().tags) is TrackedList, 'loaded values should be tracked'
+
+
+def test_new_objects_ignore_operators():
+    obj = TrackedDocument()
+    obj.tags.append('a')
+    obj.inc('counter')
+
+    assert obj.__dict__.operators == {}, 'new objects are inserted as a whole'
+    assert obj.counter == 1, 'values do not match'
+
+
+def test_list_operators():
+    obj = get_loaded_document()
+    obj.tags.append('b')
+    obj.tags.extend(['c', 'd'])
+
+    assert obj.tags == ['a', 'b', 'c', 'd'], 'values do not match'
+    assert obj.flush_update() == {'$push': {'tags': {'$each': ['b', 'c', 'd']}}}, 'expected $push'
+
+    obj.__dict__.mark_clean()
+    obj.tags.add_to_set('a', 'e')
+    assert obj.flush_update() == {'$addToSet': {'tags': {'$each': ['a', 'e']}}}, 'expected $addToSet'
+
+    obj.__dict__.mark_clean()
+    obj.tags.pull('a', 'b')
+    assert obj.tags == ['c', 'd', 'e'], 'values do not match'
+    assert obj.flush_update() == {'$pullAll': {'tags': ['a', 'b']}}, 'expected $pullAll'
+
+
+def test_incompatible_list_changes_set_the_field():
+    obj = get_loaded_document()
+    obj.tags.append('b')
+    obj.tags.pull('a')
+
+    assert obj.flush_update() == {'$set': {'tags': ['b']}}, 'expected $set of the whole list'
+
+    obj.__dict__.mark_clean()
+    obj.tags.sort()
+    obj.tags.append('c')
+    assert obj.flush_update() == {'$set': {'tags': ['b', 'c']}}, 'expected $set of the whole list'
+
+
+def test_dict_operators():
+    obj = get_loaded_document()
+    obj.attributes['b'] = 2
+    obj.attributes.update(c=3)
+
+    assert obj.flush_update() == {'$set': {'attributes.b': 2, 'attributes.c': 3}}, 'expected $set of the keys'
+
+    obj.__dict__.mark_clean()
+    del obj.attributes['a']
+    assert obj.flush_update() == {'$unset': {'attributes.a': ''}}, 'expected $unset of the key'
+
+    obj.__dict__.mark_clean()
+    obj.attributes['a.b'] = 1
+    assert obj.flush_update() == {'$set': {'attributes': {'b': 2, 'c': 3, 'a.b': 1}}}, 'expected $set of the dict'
+
+
+def test_inc():
+    obj = get_loaded_document()
+    obj.inc('counter')
+    obj.inc('counter', 5)
+
+    assert obj.counter == 7, 'values do not match'
+    assert obj.flush_update() == {'$inc': {'counter': 6}}, 'expected $inc'
+
+    obj.counter = 10
+    assert obj.flush_update() == {'$set': {'counter': 10}}, 'expected $set'
+
+
+def test_replaced_values_are_not_tracked():
+    obj = get_loaded_document()
+    tags = obj.tags
+    obj.tags = ['x']
+    obj.__dict__.mark_clean()
+    tags.append('b')
+
+    assert obj.flush_update() is None, 'old values should not report changes'
+
+
+def test_in_place_assignments_record_operators():
+    obj = get_loaded_document()
+    obj.tags += ['b']
+    assert obj.flush_update() == {'$push': {'tags': {'$each': ['b']}}}, 'expected $push'
+
+    obj.__dict__.mark_clean()
+    tags = obj.tags
+    obj.tags = ['x']
+    obj.__dict__.mark_clean()
+    obj.tags = tags
+    assert obj.flush_update() == {'$set': {'tags': ['a', 'b']}}, 'a previous value should be set as a whole'
+
+
+def test_values_assigned_to_another_field_are_copied():
+    obj = TwoListsDocument.from_db(dict(_id=ObjectId(), first=[], second=['a']))
+    obj.first = obj.second
+    obj.__dict__.mark_clean()
+    assert obj.first is not obj.second, 'the value of another field should be copied'
+
+    obj.first.append('b')
+    assert obj.flush_update() == {'$push': {'first': {'$each': ['b']}}}, 'changes should be recorded on the field'
+    assert obj.second == ['a'], 'the other field should not change'
+    TwoListsDocument.clear_all()
+
+def test_changes_made_while_writing_are_kept():
+    obj = get_loaded_document()
+    obj.inc('counter')
+    obj.tags.append('b')
+    changes = obj.__dict__.take_changes()
+    # changed while the write is awaited
+    obj.inc('counter', 2)
+    obj.attributes['b'] = 2
+
+    obj.flushed(changes)
+    assert obj.flush_update() == {'$inc': {'counter': 2}, '$set': {'attributes.b': 2}}, 'later changes should be kept'
+    assert obj in TrackedDocument.to_flush, 'object should still be flushed'
+
+    obj.flushed(obj.__dict__.take_changes())
+    assert obj not in TrackedDocument.to_flush, 'clean object should be removed from the flushing list'
+
+
+def test_failed_write_changes_are_restored():
+    obj = get_loaded_document()
+    obj.inc('counter')
+    obj.tags.append('b')
+    obj.plain = ['x']
+    changes = obj.__dict__.take_changes()
+    obj.inc('counter', 2)
+    obj.tags.pull('a')
+
+    obj.__dict__.restore_changes(changes)
+    assert obj.flush_update() == {'$inc': {'counter': 3}, '$set': {'plain': ['x'], 'tags': ['b']}}, \
+        'failed changes should be merged with the later ones'
+
+    obj = TrackedDocument()
+    changes = obj.__dict__.take_changes()
+    obj.inc('counter')
+    obj.__dict__.restore_changes(changes)
+    assert obj.__dict__.new and not obj.__dict__.has_changes, 'new objects should be inserted as a whole again'
+    TrackedDocument.clear_all()
+
+
+def test_flushed_payloads_are_copies():
+    obj = get_loaded_document()
+    obj.tags = ['a', 'b']
+    operation = obj.flush_operation()
+    obj.tags.append('c')
+    assert operation == UpdateOne({'_id': obj._id}, {'$set': {'tags': ['a', 'b']}}), \
+        'later changes should not be sent with the operation'
+
+    obj = TrackedDocument(tags=['a'])
+    operation = obj.flush_operation()
+    obj.tags.append('b')
+    obj.attributes['a'] = 1
+    assert operation == InsertOne(dict(_id=obj._id, counter=0, tags=['a'], attributes={}, plain=[])), \
+        'later changes should not be inserted'
+    TrackedDocument.clear_all()
@@ -0,0 +1,135 @@
+import asyncio
+
+from bson import ObjectId
+
+from mlight.attributes import FieldProperty
+from mlight.meta_model import MetaModel
+from mlight.unit_of_work import current_unit_of_work
+from tests.common import get_db_session, loop_runner
+
+db_session = get_db_session()
+identity_session = get_db_session(identity_map=True)
+
+
+class UnitDocument(MetaModel):
+    session = db_session
+    __model__ = 'unit_document'
+
+    _id = FieldProperty(ObjectId, if_missing=ObjectId)
+    name = FieldProperty(str, if_missing='')
+
+
+db_session.register_model(UnitDocument)
+
+
+class IdentityUnitDocument(MetaModel):
+    session = identity_session
+    __model__ = 'identity_unit_document'
+
+    _id = FieldProperty(ObjectId, if_missing=ObjectId)
+    name = FieldProperty(str, if_missing='')
+
+
+identity_session.register_model(IdentityUnitDocument)
+
+
+def test_objects_are_tracked_by_their_unit():
+    async def handler(name):
+        async with db_session.unit_of_work(flush=False) as unit_of_work:
+            assert current_unit_of_work() is unit_of_work, 'unit should be bound to the context'
+            obj = UnitDocument(name=name, attached=True)
+            # let the other handlers run
+            await asyncio.sleep(0)
+            assert list(UnitDocument.to_flush) == [obj], 'only the objects of the unit should be tracked'
+            assert len(unit_of_work) == 1, 'expected 1 item'
+        assert current_unit_of_work() is None, 'unit should be unbound on exit'
+        assert len(unit_of_work) == 0, 'objects should be discarded on exit'
+
+    async def wrapped():
+        outside = UnitDocument(attached=True)
+        await asyncio.gather(*(handler('handler %d' % x) for x in range(3)))
+        assert list(UnitDocument.to_flush) == [outside], 'objects outside units should not be affected'
+        db_session.clear_all()
+
+    loop_runner(wrapped)
+
+
+def test_nested_units_and_child_tasks():
+    async def wrapped():
+        async with db_session.unit_of_work(flush=False) as outer:
+            async with db_session.unit_of_work(flush=False) as inner:
+                UnitDocument(attached=True)
+                assert len(inner) == 1 and len(outer) == 0, 'objects should be tracked by the inner unit'
+            assert current_unit_of_work() is outer, 'outer unit should be restored'
+
+            async def child():
+                UnitDocument(attached=True)
+
+            await asyncio.ensure_future(child())
+            assert len(outer) == 1, 'child tasks should share the unit'
+
+    loop_runner(wrapped)
+
+
+def test_exception_discards_the_objects():
+    async def wrapped():
+        try:
+            async with db_session.unit_of_work() as unit_of_work:
+                obj = UnitDocument(attached=True)
+                obj.unmapped = 1
+                raise KeyError('abort')
+        except KeyError:
+            pass
+        assert len(unit_of_work) == 0, 'objects should be discarded'
+        assert len(UnitDocument.to_flush) == 0, 'objects should not leak outside the unit'
+
+    loop_runner(wrapped)
+
+
+def test_clean_exit_flushes_the_unit_objects():
+    async def wrapped():
+        try:
+            async with db_session.unit_of_work():
+                obj = UnitDocument(attached=True)
+                # the integrity check fails before any write
+                obj.unmapped = 1
+            assert False, 'objects of the unit should be flushed'
+        except AttributeError:
+            pass
+
+    loop_runner(wrapped)
+
+
+def test_units_have_their_own_identity_map():
+    _id = ObjectId()
+
+    async def handler(name, fail):
+        async with identity_session.unit_of_work(flush=False):
+            obj = IdentityUnitDocument.from_db(dict(_id=_id, name='stored'))
+            assert IdentityUnitDocument.from_db(dict(_id=_id)) is obj, 'the unit instance should be returned'
+            obj.name = name
+            # let the other handler run
+            await asyncio.sleep(0)
+            assert obj.name == name, 'changes of other units should not be seen'
+            if fail:
+                raise KeyError('abort')
+            assert obj.flush_update() == {'$set': {'name': name}}, 'changes of other units should not be flushed'
+            return obj
+
+    async def wrapped():
+        outcomes = await asyncio.gather(handler('failed', True), handler('second', False), return_exceptions=True)
+        assert type(outcomes[0]) is KeyError, 'expected the first unit to fail'
+        assert outcomes[1].name == 'second', 'values do not match'
+        assert identity_session.lookup(IdentityUnitDocument, _id) is None, 'unit objects should not be shared'
+
+    loop_runner(wrapped)
+
+
+def test_units_do_not_wait_for_other_flushes():
+    async def wrapped():
+        async with db_session._flush_lock:
+            async with db_session.unit_of_work() as unit_of_work:
+                results = await asyncio.wait_for(unit_of_work.flush(), 1)
+        assert results == {}, 'nothing should be flushed'
+
+    loop_runner(wrapped)
@@ -0,0 +1,82 @@
+import datetime
+import gc
+from collections import OrderedDict
+
+from bson import BSON, Binary, Code, Decimal128, Int64, MaxKey, MinKey, ObjectId, Regex, Timestamp
+
+from mlight.utils import LazyDocument, WeakIdentitySet
+
+
+class Item:
+    def __eq__(self, other):
+        # identity must be used, not equality
+        return True
+
+    __hash__ = object.__hash__
+
+
+def test_weak_identity_set_membership():
+    item1 = Item()
+    item2 = Item()
+    items = WeakIdentitySet()
+
+    items.add(item1)
+    items.add(item1)
+
+    assert item1 in items, 'item1 should be in the set'
+    assert item2 not in items, 'item2 should NOT be in the set'
+    assert len(items) == 1, 'expected 1 item'
+
+    items.discard(item2)
+    items.discard(item1)
+    items.discard(item1)
+
+    assert len(items) == 0, 'expected 0 items'
+
+
+def test_weak_identity_set_insertion_order():
+    objects = [Item() for _ in range(10)]
+    items = WeakIdentitySet(reversed(objects))
+
+    assert list(items) == list(reversed(objects)), 'insertion order should be preserved'
+
+
+def test_weak_identity_set_drops_collected_objects():
+    items = WeakIdentitySet()
+    item = Item()
+    items.add(item)
+    items.add(Item())
+    gc.collect()
+
+    assert len(items) == 1, 'expected 1 item'
+    assert list(items)[0] is item, 'wrong item left in the set'
+
+
+def test_weak_identity_set_discard_while_iterating():
+    objects = [Item() for _ in range(10)]
+    items = WeakIdentitySet(objects)
+
+    visited = 0
+    for item in items:
+        items.discard(item)
+        visited += 1
+
+    assert visited == 10, 'every item should be visited'
+    assert len(items) == 0, 'expected 0 items'
+
+
+def test_lazy_document_decodes_single_elements():
+    document = OrderedDict([
+        ('_id', ObjectId()), ('double', 1.5), ('string', 'value'), ('document', {'a': [1, 2]}),
+        ('array', [1, 'two', {'three': 3}]), ('binary', Binary(b'\x00\x01', 5)), ('bool', True),
+        ('date', datetime.datetime(2020, 1, 1)), ('null', None), ('regex', Regex('^a', 'i')),
+        ('int32', 32), ('timestamp', Timestamp(1, 2)), ('int64', Int64(2 ** 40)),
+        ('decimal', Decimal128('1.1')), ('code', Code('function(){}')), ('min', MinKey()), ('max', MaxKey()),
+    ])
+    lazy = LazyDocument(BSON.encode(document))
+
+    assert list(lazy.keys()) == list(document.keys()), 'keys do not match'
+    for name, value in document.items():
+        decoded = lazy.decode(name)
+        assert decoded == value, "'%s' does not match" % name
+    assert 'other' not in lazy, 'unexpected key'
@@ -0,0 +1,130 @@
+from bson import ObjectId
+
+from mlight.attributes import FieldProperty
+from mlight.meta_model import MetaModel
+from mlight.write_buffer import BufferedWrite, INSERT, UPDATE, WriteBuffer, merge_into_document, merge_updates
+from tests.common import get_db_session, loop_runner
+
+db_session = get_db_session()
+
+
+class BufferedDocument(MetaModel):
+    session = db_session
+    __model__ = 'buffered_document'
+
+    _id = FieldProperty(ObjectId, if_missing=ObjectId)
+    name = FieldProperty(str)
+    counter = FieldProperty(int, if_missing=0)
+    tags = FieldProperty(list, tracked=True, if_missing=list)
+
+
+db_session.register_model(BufferedDocument)
+
+
+def test_merge_updates():
+    merged = merge_updates({'$set': {'a': 1}, '$inc': {'b': 1}}, {'$set': {'c': 2}, '$inc': {'b': 2}})
+    assert merged == {'$set': {'a': 1, 'c': 2}, '$inc': {'b': 3}}, 'sets should be combined and incs summed'
+
+    merged = merge_updates({'$inc': {'b': 1}, '$unset': {'c': ''}}, {'$set': {'b': 5, 'c': 1}})
+    assert merged == {'$set': {'b': 5, 'c': 1}}, 'later sets should override earlier changes'
+
+    merged = merge_updates({'$set': {'b': 1}}, {'$inc': {'b': 2}})
+    assert merged == {'$set': {'b': 3}}, 'incs of a set field should be applied on the value'
+
+    merged = merge_updates({'$push': {'t': {'$each': [1]}}}, {'$push': {'t': {'$each': [2, 3]}}})
+    assert merged == {'$push': {'t': {'$each': [1, 2, 3]}}}, 'pushes should be concatenated'
+
+    merged = merge_updates({'$set': {'d': {'x': 1}}}, {'$set': {'d.y': 2}, '$unset': {'d.x': ''}})
+    assert merged == {'$set': {'d': {'y': 2}}}, 'embedded changes should be applied on the set value'
+
+    assert merge_updates({'$push': {'t': {'$each': [1]}}}, {'$pullAll': {'t': [1]}}) is None, \
+        'different array operators cannot be merged'
+    assert merge_updates({'$inc': {'d.x': 1}}, {'$inc': {'d': 1}}) is None, 'conflicting paths cannot be merged'
+
+
+def test_merge_into_document():
+    document = {'_id': 1, 'a': 1, 'tags': ['x'], 'd': {'x': 1}}
+    update = {'$inc': {'a': 2}, '$push': {'tags': {'$each': ['y']}}, '$set': {'d.y': 2}, '$unset': {'d.x': ''}}
+
+    assert merge_into_document(document, update) == {'_id': 1, 'a': 3, 'tags': ['x', 'y'], 'd': {'y': 2}}, \
+        'update should be applied on the document'
+    assert document == {'_id': 1, 'a': 1, 'tags': ['x'], 'd': {'x': 1}}, 'document should not be changed'
+    assert merge_into_document(document, {'$unset': {'a': ''}}) == {'_id': 1, 'tags': ['x'], 'd': {'x': 1}}, \
+        'unset field should be removed'
+    assert merge_into_document(document, {'$inc': {'missing.x': 1}}) is None, 'missing paths cannot be merged'
+
+
+def test_buffered_write():
+    entry = BufferedWrite(BufferedDocument, 1)
+    entry.add(INSERT, {'_id': 1, 'counter': 0})
+    entry.add(UPDATE, {'$inc': {'counter': 1}})
+    entry.add(UPDATE, {'$inc': {'counter.x': 1}})
+
+    assert entry.operations == [(INSERT, {'_id': 1, 'counter': 1}), (UPDATE, {'$inc': {'counter.x': 1}})], \
+        'unmergeable updates should be kept in order'
+    assert entry.size > 0, 'size should be computed'
+    assert len(entry.write_operations()) == 2, 'expected one operation per buffered write'
+
+
+def test_write_buffer_merges_flushes():
+    buffer = WriteBuffer(60)
+
+    async def wrapped():
+        obj = BufferedDocument(name='first')
+        await buffer.add(obj)
+
+        for _ in range(3):
+            obj.inc('counter')
+            obj.tags.append('a')
+            await buffer.add(obj)
+        obj.name = 'second'
+        await buffer.add(obj)
+        obj.tags.append('b')
+
+        assert len(buffer) == 1, 'writes of the same document should be merged'
+        entry = buffer._entries[(BufferedDocument, obj._id)]
+        assert entry.operations == [(INSERT, dict(_id=obj._id, name='second', counter=3, tags=['a', 'a', 'a']))], \
+            'updates should be merged in the insert'
+        assert buffer.buffered_bytes == entry.size, 'buffered bytes should be tracked'
+        buffer._handle.cancel()
+        db_session.clear_all()
+
+    loop_runner(wrapped)
+
+
+def test_transactional_flush_is_not_buffered():
+    session = get_db_session(write_behind=60)
+
+    async def wrapped():
+        try:
+            await session.flush_all(transactional=True)
+            assert False, 'expected ValueError'
+        except ValueError:
+            pass
+
+    loop_runner(wrapped)
+
+
+def test_requeued_operations_come_first():
+    buffer = WriteBuffer(60)
+    failed = BufferedWrite(BufferedDocument, 1)
+    failed.add(INSERT, {'_id': 1, 'counter': 0})
+    failed.add(UPDATE, {'$inc': {'counter.x': 1}})
+
+    async def wrapped():
+        obj = BufferedDocument.from_db(dict(_id=1, counter=1))
+        obj.inc('counter')
+        await buffer.add(obj)
+        buffer._handle.cancel()
+        buffer._handle = None
+
+        buffer._requeue([(failed, operation) for operation in failed.operations])
+        entry = buffer._entries[(BufferedDocument, 1)]
+        assert entry.operations[:2] == failed.operations, 'operations not written should come first'
+        assert entry.operations[2][1]['$inc'] == {'counter': 1}, 'newer operations should follow'
+        assert buffer.buffered_bytes == entry.size, 'buffered bytes should be recomputed'
+        assert buffer._handle is not None, 'a new write should be scheduled'
+        buffer._handle.cancel()
+        db_session.clear_all()
+
+    loop_runner(wrapped)